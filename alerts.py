@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+import threading
+from collections import deque
+from time import monotonic
+import metrics
+
+dedup_window = 60  # seconds an identical title/message pair is dropped for after it was queued
+batch_window = 2  # seconds a burst is gathered behind its first alert before being sent
+rate_limits = {None: (6, 60)}  # priority -> (notifications, per seconds), None covers priorities not listed
+max_depth = 100
+
+outcomes = metrics.Counter('restate_alerts_total', 'Alerts by what became of them', ('outcome',))
+
+
+class Alert:
+    def __init__(self, message, title, priority, api_token):
+        self.message = message
+        self.title = title
+        self.priority = priority
+        self.api_token = api_token
+        self.queued = monotonic()
+
+
+# Sends alerts from a background thread so requests never wait on the notification backend. Repeats of a queued alert
+# are dropped, a burst with the same priority and token goes out as one summary, and each priority has a token bucket
+# that holds alerts back (to be folded into a later summary) once its rate is used up
+class AlertQueue:
+    def __init__(self, send, dedup_window=dedup_window, batch_window=batch_window, rate_limits=rate_limits,
+                 max_depth=max_depth):
+        self.send = send  # ntfy.notify compatible, returning 0 on success
+        self.dedup_window = dedup_window
+        self.batch_window = batch_window
+        self.rate_limits = rate_limits
+        self.max_depth = max_depth
+        self._pending = deque()  # alerts still inside the batch window
+        self._held = {}  # priority -> alerts gathered and waiting to be sent
+        self._retry = {}  # priority -> when its bucket next has a token, for priorities that ran out
+        self._condition = threading.Condition()
+        self._seen = {}  # (title, message) -> when it was last queued
+        self._buckets = {}  # priority -> (tokens, when they were counted)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @property
+    def depth(self):
+        return len(self._pending) + sum(len(alerts) for alerts in list(self._held.values()))
+
+    # Queue an alert, returning 'queued', 'duplicate' or 'full'
+    def submit(self, message, title, priority=None, api_token=None):
+        key = (title, message)
+        with self._condition:
+            now = monotonic()
+            if now - self._seen.get(key, now - self.dedup_window) < self.dedup_window:
+                outcomes.inc('duplicate')
+                return 'duplicate'
+            if self.depth >= self.max_depth:
+                outcomes.inc('dropped')
+                return 'full'
+            if len(self._seen) > self.max_depth:
+                self._seen = {k: v for k, v in self._seen.items() if now - v < self.dedup_window}
+            self._seen[key] = now
+            self._pending.append(Alert(message, title, priority, api_token))
+            self._condition.notify()
+        outcomes.inc('queued')
+        return 'queued'
+
+    # Wait until a priority has alerts to send and a token to send them with, returning priority -> alerts
+    def _next(self):
+        with self._condition:
+            while True:
+                now = monotonic()
+                # Let the rest of a burst arrive before anything is sent
+                ready = self._pending[0].queued + self.batch_window if self._pending else None
+                if ready is not None and ready <= now:
+                    for alert in self._pending:
+                        self._held.setdefault(alert.priority, []).append(alert)
+                    self._pending.clear()
+                    ready = None
+                due = [priority for priority in self._held if self._retry.get(priority, now) <= now]
+                if due:
+                    for priority in due:
+                        self._retry.pop(priority, None)
+                    return {priority: self._held.pop(priority) for priority in due}
+                wakes = [at for at in [ready, *self._retry.values()] if at is not None]
+                self._condition.wait(min(wakes) - now if wakes else None)
+
+    def _run(self):
+        while True:
+            for priority, alerts in self._next().items():
+                groups = {}
+                for alert in alerts:
+                    groups.setdefault(alert.api_token, []).append(alert)
+                held, delay = [], 0
+                for group in groups.values():
+                    delay = delay or self._take(priority)
+                    if delay:
+                        held.extend(group)
+                    else:
+                        self._dispatch(group)
+                # Out of tokens, hold these back for a later summary without holding up the other priorities
+                if held:
+                    with self._condition:
+                        self._held[priority] = held + self._held.get(priority, [])
+                        self._retry[priority] = monotonic() + delay
+
+    # Spend a token for priority, returning 0 or the seconds until one is available
+    def _take(self, priority):
+        count, period = self.rate_limits.get(priority, self.rate_limits[None])
+        now = monotonic()
+        tokens, stamp = self._buckets.get(priority, (count, now))
+        tokens = min(count, tokens + (now - stamp) * count / period)
+        if tokens < 1:
+            self._buckets[priority] = (tokens, now)
+            return (1 - tokens) * period / count
+        self._buckets[priority] = (tokens - 1, now)
+        return 0
+
+    def _dispatch(self, group):
+        first = group[0]
+        if len(group) == 1:
+            title, message = first.title, first.message
+        elif all(alert.title == first.title for alert in group):
+            title, message = f'{first.title} ({len(group)})', '\n'.join(alert.message for alert in group)
+        else:
+            title, message = f'{len(group)} alerts', '\n'.join(f'{alert.title}: {alert.message}' for alert in group)
+        if len(group) > 1:
+            outcomes.inc('batched', amount=len(group) - 1)
+
+        kwargs = {'message': message, 'title': title, 'priority': first.priority, 'api_token': first.api_token}
+        label = first.priority or 'default'
+        now = monotonic()
+        for alert in group:
+            metrics.latency.observe(now - alert.queued, 'SendAlert', label, 'queue')
+        try:
+            with metrics.timed('SendAlert', label, 'ntfy'):
+                result = self.send(**{k: v for k, v in kwargs.items() if v is not None})
+        except Exception:
+            result = None
+        if result != 0:
+            if result is not None:
+                metrics.error('SendAlert', label, 'ntfy')
+            outcomes.inc('failed')
+        else:
+            outcomes.inc('sent')
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+# Load test comparing the waitress entry point with room_api_async while devices hang. A fake meross bulb that never
+# answers within the timeout is hammered with PUTs while GETs of /api/v1.0 are timed, showing whether slow device I/O
+# starves the rest of the API. Usage: python3 bench/async_load.py [waitress|async] [hung requests] [seconds]
+
+import os
+import sys
+import json
+import socket
+import threading
+from time import monotonic, sleep
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor
+from statistics import median
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+hang = 10  # seconds the fake bulb sits on each request, matching the Snowdon timeout
+
+
+class HungBulb(BaseHTTPRequestHandler):
+    def do_POST(self):
+        sleep(hang)
+
+    def log_message(self, *args):
+        pass
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(mode, port):
+    import room_api
+    if mode == 'async':
+        import uvicorn
+        import room_api_async
+        server = uvicorn.Server(uvicorn.Config(room_api_async.app, host='127.0.0.1', port=port, lifespan='off',
+                                               log_level='warning'))
+        threading.Thread(target=server.run, daemon=True).start()
+    else:
+        from waitress import create_server
+        server = create_server(room_api.app, host='127.0.0.1', port=port, threads=10)
+        threading.Thread(target=server.run, daemon=True).start()
+    return room_api
+
+
+def main():
+    mode = sys.argv[1] if len(sys.argv) > 1 else 'async'
+    hung = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    duration = float(sys.argv[3]) if len(sys.argv) > 3 else 5
+
+    bulb = ThreadingHTTPServer(('127.0.0.1', 0), HungBulb)
+    threading.Thread(target=bulb.serve_forever, daemon=True).start()
+
+    port = free_port()
+    room_api = start_server(mode, port)
+    room_api.sessions.pools['office'].host = f'127.0.0.1:{bulb.server_address[1]}'
+    room_api.sessions.pools['office'].timeout = (1.5, hang + 1)
+    sleep(0.5)
+
+    base = f'http://127.0.0.1:{port}/api/v1.0'
+    clients = ThreadPoolExecutor(max_workers=hung + 1)
+    for _ in range(hung):
+        clients.submit(requests.put, f'{base}/meross/office', json={'code': 'toggle', 'value': '1'}, timeout=hang + 5)
+    sleep(0.5)
+
+    latencies, failures = [], 0
+    end = monotonic() + duration
+    while monotonic() < end:
+        start = monotonic()
+        try:
+            requests.get(base, timeout=duration)
+            latencies.append(monotonic() - start)
+        except requests.exceptions.RequestException:
+            failures += 1
+
+    print(json.dumps({
+        'mode': mode,
+        'hung_requests': hung,
+        'gets_completed': len(latencies),
+        'gets_failed': failures,
+        'get_p50_ms': round(median(latencies) * 1000, 2) if latencies else None,
+        'get_max_ms': round(max(latencies) * 1000, 2) if latencies else None,
+    }))
+    os._exit(0)  # the hung requests are still outstanding
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+# A stand-in for lircd's unix socket, answering SEND_ONCE, SEND_START, SEND_STOP and LIST for a set of fake remotes and
+# recording every command it was sent. Run standalone with: python3 bench/fake_lircd.py /tmp/lircd
+
+import os
+import sys
+import socket
+import threading
+import socketserver
+from time import sleep
+
+remotes = {
+    'bulb': {'key_power': '0000000000ff00ff', 'key_up': '0000000000ff807f', 'key_down': '0000000000ff40bf'},
+    'strip': {'key_power': '0000000000f7c03f', 'key_red': '0000000000f720df'},
+}
+
+
+class FakeLircd(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, remotes=remotes, latency=0):
+        if os.path.exists(path):
+            os.unlink(path)
+        self.remotes = remotes
+        self.latency = latency  # seconds to wait before replying, irsend on a pi is slow to emit
+        self.commands = []
+        self.held = {}
+        self.connections = set()
+        super().__init__(path, LircdHandler)
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    # Like a lircd restart, drop every client connection as well as the listening socket
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        for connection in list(self.connections):
+            connection.shutdown(socket.SHUT_RDWR)
+        os.unlink(self.server_address)
+
+    def reply(self, command):
+        words = command.split()
+        self.commands.append(command)
+        if not words:
+            return False, ['bad send packet']
+        if words[0] == 'LIST':
+            if len(words) == 1:
+                return True, list(self.remotes)
+            if words[1] not in self.remotes:
+                return False, [f'unknown remote: "{words[1]}"']
+            return True, [f'{value} {name.upper()}' for name, value in self.remotes[words[1]].items()]
+        if words[0] in ('SEND_ONCE', 'SEND_START', 'SEND_STOP') and len(words) >= 3:
+            if words[1] not in self.remotes:
+                return False, [f'unknown remote: "{words[1]}"']
+            if words[2].lower() not in self.remotes[words[1]]:
+                return False, [f'unknown command: "{words[2]}"']
+            if words[0] == 'SEND_START':
+                self.held[words[1]] = words[2]
+            elif words[0] == 'SEND_STOP':
+                if self.held.pop(words[1], None) is None:
+                    return False, ['not repeating']
+            return True, []
+        return False, [f'unknown directive: "{words[0]}"']
+
+
+class LircdHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.server.connections.add(self.connection)
+        for line in self.rfile:
+            command = line.decode().strip()
+            if self.server.latency:
+                sleep(self.server.latency)
+            success, data = self.server.reply(command)
+            packet = ['BEGIN', command, 'SUCCESS' if success else 'ERROR']
+            if data:
+                packet += ['DATA', str(len(data))] + data
+            packet.append('END')
+            self.wfile.write(('\n'.join(packet) + '\n').encode())
+        self.server.connections.discard(self.connection)
+
+
+if __name__ == '__main__':
+    server = FakeLircd(sys.argv[1] if len(sys.argv) > 1 else '/tmp/lircd')
+    print(f'fake lircd listening on {server.server_address}')
+    server.serve_forever()
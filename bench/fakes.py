@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+# Local stand-ins for every backend room_api talks to, so the API can be exercised without the TV, bulbs, Pico
+# repeaters or lircd: a Meross /config emulator per device, a pty serial TV driven by SerialLookup, lircd on a unix
+# socket, RFCOMM peers over socketpairs and a Snowdon server. Each fake records what it was sent
+
+import os
+import sys
+import json
+import random
+import socket
+import threading
+from time import sleep
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_lircd import FakeLircd
+
+
+class _Quiet(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real devices
+    wbufsize = -1  # send headers and body as one segment, split writes stall ~40ms on delayed acks
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class _HTTPFake(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, handler, latency, failure_rate):
+        self.latency = latency  # seconds to sit on every request
+        self.failure_rate = failure_rate  # fraction of requests answered with a 500
+        self.requests = []
+        super().__init__(('127.0.0.1', 0), handler)
+
+    @property
+    def host(self):
+        return f'127.0.0.1:{self.server_address[1]}'
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    # Wait out the latency and decide whether this request fails
+    def delay(self):
+        if self.latency:
+            sleep(self.latency)
+        return random.random() < self.failure_rate
+
+
+class MerossHandler(_Quiet):
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        self.server.requests.append(body)
+        if self.path != '/config':
+            return self.reply(404, {})
+        if self.server.delay():
+            return self.reply(500, {})
+        namespace = body.get('header', {}).get('namespace')
+        payload = body.get('payload', {})
+        state = self.server.state
+        if namespace == 'Appliance.System.All':
+            return self.reply(200, {'payload': {'all': {'digest': {
+                'togglex': [{'onoff': state['onoff']}],
+                'light': {'rgb': state['rgb'], 'temperature': state['temperature'], 'luminance': state['luminance']}}}}})
+        if namespace == 'Appliance.Control.ToggleX':
+            state['onoff'] = payload['togglex']['onoff']
+        elif namespace == 'Appliance.Control.Light':
+            for field in ('rgb', 'temperature', 'luminance'):
+                if field in payload['light'] and payload['light'][field] != -1:
+                    state[field] = payload['light'][field]
+        self.reply(200, {'header': body.get('header'), 'payload': {}})
+
+
+# One emulated bulb, answering status with its current state and folding every SET into it
+class FakeMeross(_HTTPFake):
+    def __init__(self, latency=0, failure_rate=0):
+        self.state = {'onoff': 0, 'rgb': 0xff00ff, 'temperature': 50, 'luminance': 100}
+        super().__init__(MerossHandler, latency, failure_rate)
+
+
+class SnowdonHandler(_Quiet):
+    def do_PUT(self):
+        code = parse_qs(urlparse(self.path).query).get('code', [None])[0]
+        self.server.requests.append(code)
+        if self.server.delay():
+            return self.reply(500, {'message': 'Unexpected response'})
+        self.reply(200, {'message': 'Success', 'code': code})
+
+
+class FakeSnowdon(_HTTPFake):
+    def __init__(self, latency=0, failure_rate=0):
+        super().__init__(SnowdonHandler, latency, failure_rate)
+
+
+# A TV on the far end of a pseudo terminal. Commands are '<name> <set id> <value>\r' and replies
+# '<name[1]> 01 OK<value>x', with a value of ff asking for the current setting instead of changing it
+class FakeTvCom:
+    def __init__(self, lookups, latency=0):
+        self.lookups = {instance.name: instance for instance in lookups}
+        self.latency = latency  # seconds between reading a command and replying, the real TV takes ~0.1
+        self.state = {name: '01' for name in self.lookups}
+        self.commands = []
+        self._master, self._slave = os.openpty()
+        self.port = os.ttyname(self._slave)
+
+    def start(self):
+        threading.Thread(target=self._serve, daemon=True).start()
+        return self
+
+    def _serve(self):
+        buffer = b''
+        while True:
+            try:
+                data = os.read(self._master, 64)
+            except OSError:
+                return
+            buffer += data
+            while b'\r' in buffer:
+                line, buffer = buffer.split(b'\r', 1)
+                reply = self.reply(line.decode().strip())
+                if self.latency:
+                    sleep(self.latency)
+                os.write(self._master, reply.encode())
+
+    def reply(self, command):
+        self.commands.append(command)
+        words = command.split()
+        if len(words) != 3 or words[0] not in self.lookups:
+            return ''  # the TV stays silent on anything it does not understand
+        name, value = words[0], words[2]
+        if value != 'ff':
+            self.state[name] = value
+        return f'{name[1]} 01 OK{self.state[name]}x'
+
+    def stop(self):
+        os.close(self._master)
+        os.close(self._slave)
+
+
+# Pico repeaters reached over socketpairs. Pass connect in place of rfcomm.rfcomm_connect; every code written to a
+# peer is acknowledged with OK\r\n after latency seconds
+class FakeRfcomm:
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.codes = []
+
+    def connect(self, address, timeout):
+        ours, theirs = socket.socketpair()
+        ours.settimeout(timeout)
+        threading.Thread(target=self._serve, args=(address, theirs), daemon=True).start()
+        return ours
+
+    def _serve(self, address, sock):
+        buffer = b''
+        with sock:
+            while True:
+                try:
+                    data = sock.recv(64)
+                except OSError:
+                    return
+                if not data:
+                    return
+                buffer += data
+                while b'\r' in buffer:
+                    code, buffer = buffer.split(b'\r', 1)
+                    self.codes.append((address, code.decode()))
+                    if self.latency:
+                        sleep(self.latency)
+                    sock.sendall(b'OK\r\n')
+
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+
+# Load test of the whole API against the local fakes in bench/fakes.py. Every scenario is run at each concurrency level
+# and its throughput and p50/p95/p99 latency reported, then saved to bench/results/<commit>.json so two commits can be
+# compared. Usage:
+#   python3 bench/load.py [waitress|async] [seconds per run] [--latency s] [--failure-rate f]
+#   python3 bench/load.py compare <commit or results file> <commit or results file>
+# Results from a tree with uncommitted changes are saved as <commit>-dirty.json
+
+import os
+import sys
+import json
+import socket
+import logging
+import argparse
+import tempfile
+import threading
+import subprocess
+from time import monotonic, sleep
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+bench_path = os.path.dirname(os.path.abspath(__file__))
+results_path = os.path.join(bench_path, 'results')
+sys.path.insert(0, os.path.dirname(bench_path))
+sys.path.insert(0, bench_path)
+
+import fakes
+
+concurrency_levels = (1, 4, 16)
+
+# name -> (method, path under /api/v1.0/, json body)
+scenarios = {
+    'root': ('GET', '', None),
+    'meross_status': ('PUT', 'meross/office', {'code': 'status'}),
+    'meross_toggle': ('PUT', 'meross/office', {'code': 'toggle', 'value': '1'}),
+    'meross_luminance': ('PUT', 'meross/office', {'code': 'luminance', 'value': '50'}),
+    'meross_all_status': ('PUT', 'meross', {'hosts': 'office,hall_down,hall_up,attic,bedroom', 'code': 'status'}),
+    'tvcom_status': ('PUT', 'tvcom/volume', {'code': 'status'}),
+    'tvcom_adjust': ('PUT', 'tvcom/volume', {'code': '+1'}),
+    'lircd': ('PUT', 'bench_led', {'code': 'key_power'}),
+    'rfcomm': ('PUT', 'bench_bt', {'code': 'key_power'}),
+    'snowdon': ('PUT', 'snowdon', {'code': 'power'}),
+    'batch': ('PUT', 'batch', {'steps': [{'endpoint': 'meross/office', 'code': 'toggle', 'value': '0'},
+                                         {'endpoint': 'tvcom/volume', 'code': 'status'},
+                                         {'endpoint': 'snowdon', 'code': 'power'}]}),
+}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+# Short hash of HEAD, suffixed -dirty when tracked files have uncommitted changes so the run is not mistaken for HEAD's
+def commit():
+    try:
+        sha = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=bench_path, text=True).strip()
+        changes = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=bench_path,
+                                          text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return f'{sha}-dirty' if changes else sha
+
+
+# Start a fake for every backend and point room_api at them before anything has connected
+def start_fakes(latency, failure_rate):
+    import lirc
+    import rfcomm
+    import room_api
+    from tvcom.serial_lookup import SerialLookup
+
+    started = {'meross': {}}
+    for name in room_api.meross_clients:
+        bulb = started['meross'][name] = fakes.FakeMeross(latency, failure_rate).start()
+        room_api.sessions.pools[name].host = bulb.host
+
+    started['snowdon'] = fakes.FakeSnowdon(latency, failure_rate).start()
+    room_api.sessions.pools['snowdon'].host = started['snowdon'].host
+
+    started['tvcom'] = fakes.FakeTvCom(SerialLookup.lookups, latency).start()
+    room_api.tvcom_worker.port = started['tvcom'].port
+
+    lircd_path = os.path.join(tempfile.mkdtemp(), 'lircd')
+    started['lircd'] = fakes.FakeLircd(lircd_path, latency=latency).start()
+    lirc.client.path = lircd_path
+    lirc.keycodes.paths = []
+
+    started['rfcomm'] = fakes.FakeRfcomm(latency)
+    rfcomm.links.connect = started['rfcomm'].connect
+
+    # LEDRemote and BluetoothRemote have no routes of their own yet, give them bench only ones
+    room_api.api.add_resource(room_api.LEDRemote, f'{room_api.base_path}bench_led', endpoint='bench_led',
+                              resource_class_kwargs={'device_name': 'bulb'})
+    room_api.api.add_resource(room_api.BluetoothRemote, f'{room_api.base_path}bench_bt', endpoint='bench_bt',
+                              resource_class_kwargs={'lirc_device': 'bulb', 'serial': '00:00:00:00:00:01',
+                                                     'timeout': room_api.timeout})
+    return room_api, started
+
+
+def start_server(room_api, mode, port):
+    if mode == 'async':
+        import uvicorn
+        import room_api_async
+        server = uvicorn.Server(uvicorn.Config(room_api_async.app, host='127.0.0.1', port=port, lifespan='off',
+                                               log_level='warning'))
+    else:
+        from waitress import create_server
+        server = create_server(room_api.app, host='127.0.0.1', port=port, threads=10)
+    threading.Thread(target=server.run, daemon=True).start()
+    for _ in range(50):
+        try:
+            requests.get(f'http://127.0.0.1:{port}/api/v1.0', timeout=1)
+            return
+        except requests.exceptions.ConnectionError:
+            sleep(0.1)
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+# Hammer one scenario from concurrency clients, each with its own keep-alive session, for duration seconds
+def run(base, scenario, concurrency, duration):
+    method, path, body = scenario
+    url = f'{base}/{path}'.rstrip('/')
+    end = monotonic() + duration
+
+    def client():
+        latencies, failures = [], 0
+        with requests.Session() as session:
+            while monotonic() < end:
+                start = monotonic()
+                try:
+                    response = session.request(method, url, json=body, timeout=30)
+                    if response.status_code >= 400:
+                        failures += 1
+                    else:
+                        latencies.append(monotonic() - start)
+                except requests.exceptions.RequestException:
+                    failures += 1
+        return latencies, failures
+
+    start = monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as clients:
+        outcomes = list(clients.map(lambda _: client(), range(concurrency)))
+    elapsed = monotonic() - start
+    latencies = [latency for outcome in outcomes for latency in outcome[0]]
+    return {
+        'requests': len(latencies),
+        'failures': sum(outcome[1] for outcome in outcomes),
+        'throughput': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2) if latencies else None,
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 2) if latencies else None,
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+    }
+
+
+def load_results(name):
+    path = name if os.path.exists(name) else os.path.join(results_path, f'{name}.json')
+    with open(path) as f:
+        return json.load(f)
+
+
+# Print the change in throughput and p95 for every scenario and concurrency present in both result sets
+def compare(old_name, new_name):
+    old, new = load_results(old_name), load_results(new_name)
+    print(f"{'scenario':<20}{'clients':>8}{'req/s':>18}{'p95 ms':>22}")
+    for name, levels in new['scenarios'].items():
+        for concurrency, result in levels.items():
+            before = old['scenarios'].get(name, {}).get(concurrency)
+            if before is None:
+                continue
+            throughput = f"{before['throughput']} -> {result['throughput']}"
+            p95 = f"{before['p95_ms']} -> {result['p95_ms']}"
+            print(f'{name:<20}{concurrency:>8}{throughput:>18}{p95:>22}')
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'compare':
+        return compare(sys.argv[2], sys.argv[3])
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('mode', nargs='?', choices=('waitress', 'async'), default='waitress')
+    parser.add_argument('duration', nargs='?', type=float, default=3)
+    parser.add_argument('--latency', type=float, default=0, help='seconds every fake backend waits before replying')
+    parser.add_argument('--failure-rate', type=float, default=0, help='fraction of HTTP backend requests that fail')
+    parser.add_argument('--scenario', action='append', choices=scenarios, help='run only these scenarios')
+    args = parser.parse_args()
+
+    logging.getLogger('waitress.queue').setLevel(logging.ERROR)  # backlog warnings are expected at 16 clients
+    room_api, started = start_fakes(args.latency, args.failure_rate)
+    port = free_port()
+    start_server(room_api, args.mode, port)
+    base = f'http://127.0.0.1:{port}/api/v1.0'
+
+    results = {'commit': commit(), 'mode': args.mode, 'duration': args.duration, 'latency': args.latency,
+               'failure_rate': args.failure_rate, 'scenarios': {}}
+    for name in args.scenario or scenarios:
+        results['scenarios'][name] = {}
+        for concurrency in concurrency_levels:
+            result = results['scenarios'][name][str(concurrency)] = run(base, scenarios[name], concurrency,
+                                                                        args.duration)
+            print(f"{name:<20}{concurrency:>4} clients  {result['throughput']:>8} req/s  p50 {result['p50_ms']} ms  "
+                  f"p95 {result['p95_ms']} ms  p99 {result['p99_ms']} ms  failures {result['failures']}")
+
+    os.makedirs(results_path, exist_ok=True)
+    path = os.path.join(results_path, f"{results['commit']}.json")
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'results written to {path}')
+    os._exit(0)  # worker threads blocked on the fakes would otherwise hold the process open
+
+
+if __name__ == '__main__':
+    main()
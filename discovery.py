@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+import json
+from functools import wraps
+from hashlib import sha1
+from flask import Response, request
+
+documents = {}  # endpoint -> Document
+
+
+# A discovery response serialized once, served as the same bytes with a strong ETag every time
+class Document:
+    def __init__(self, body):
+        self.body = body
+        self.data = (json.dumps(body) + '\n').encode()
+        self.etag = sha1(self.data).hexdigest()
+
+    # Answer a GET from the stored bytes, or with a 304 if the client already holds them
+    def response(self):
+        response = Response(self.data, content_type='application/json', headers={'Cache-Control': 'no-cache'})
+        response.set_etag(self.etag)
+        return response.make_conditional(request)
+
+
+# For GETs whose response never changes once the routes are registered. The first call for each endpoint builds the
+# document from the wrapped (body, status) and every later call is served from it
+def cached(get):
+    @wraps(get)
+    def wrapper(self):
+        document = documents.get(request.endpoint)
+        if document is None:
+            body, _ = get(self)
+            document = documents[request.endpoint] = Document(body)
+        return document.response()
+    wrapper.cached = True
+    return wrapper
+
+
+# Build the document of every cached GET up front, resources with precompute_last set (e.g a catalog made from the
+# other documents) after the rest
+def precompute(app):
+    views = [(rule, app.view_functions[rule.endpoint]) for rule in app.url_map.iter_rules()]
+    for rule, view in sorted(views, key=lambda item: getattr(getattr(item[1], 'view_class', None), 'precompute_last', False)):
+        get = getattr(getattr(view, 'view_class', None), 'get', None)
+        if getattr(get, 'cached', False) and rule.endpoint not in documents:
+            with app.test_request_context(rule.rule):
+                view()
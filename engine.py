@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from time import monotonic
+
+
+# A single long-lived event loop that fans blocking device calls out to a bounded pool of workers. Request threads hand
+# work to it and wait on the result, so a fan-out never creates its own loop or takes extra server threads
+class Engine:
+    def __init__(self, concurrency, lane_concurrency=None):
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='engine')
+        # Lane steps get a pool of their own, a step that fans out again (e.g through gather) must not wait on workers
+        # that are busy running steps
+        self.lane_executor = ThreadPoolExecutor(max_workers=lane_concurrency or concurrency, thread_name_prefix='lane')
+        self._thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self._thread.start()
+
+    # Schedule a coroutine on the engine loop from any thread and block until it completes
+    def run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    # Run a blocking callable on the worker pool, usable from coroutines running on the engine loop
+    async def call(self, func, *args, executor=None):
+        return await self.loop.run_in_executor(executor or self.executor, func, *args)
+
+    async def _call_with_timeout(self, func, timeout):
+        try:
+            return await asyncio.wait_for(self.call(func), timeout)
+        except Exception as e:
+            return e
+
+    async def _gather(self, calls, timeout):
+        results = await asyncio.gather(*(self._call_with_timeout(func, timeout) for func in calls.values()))
+        return dict(zip(calls.keys(), results))
+
+    # Run a dict of name -> callable concurrently, returning name -> result. A call that raised or did not finish within
+    # timeout seconds has the exception (asyncio.TimeoutError for the latter) as its result
+    def gather(self, calls, timeout):
+        return self.run(self._gather(calls, timeout))
+
+    # Like gather, but yields (name, result) pairs to the calling thread in the order the calls finish
+    def as_completed(self, calls, timeout):
+        futures = {asyncio.run_coroutine_threadsafe(self._call_with_timeout(func, timeout), self.loop): name
+                   for name, func in calls.items()}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+    async def _lane(self, calls):
+        results = []
+        for func in calls:
+            start = monotonic()
+            try:
+                result = await self.call(func, executor=self.lane_executor)
+            except Exception as e:
+                result = e
+            results.append((result, monotonic() - start))
+        return results
+
+    async def _lanes(self, lanes):
+        results = await asyncio.gather(*(self._lane(calls) for calls in lanes.values()))
+        return dict(zip(lanes.keys(), results))
+
+    # Run a dict of name -> list of callables, each list in order but all lists concurrently. Returns name -> list of
+    # (result or exception, seconds taken)
+    def lanes(self, lanes):
+        return self.run(self._lanes(lanes))
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+
+import threading
+from collections import deque
+
+
+# Events waiting for one subscriber. When a slow client falls queue_size events behind the oldest are dropped, a later
+# event for the same device supersedes them anyway
+class Subscription:
+    def __init__(self, topics, queue_size):
+        self.topics = topics  # set of topics to receive, None for all
+        self._events = deque(maxlen=queue_size)
+        self._condition = threading.Condition()
+
+    def put(self, event):
+        with self._condition:
+            self._events.append(event)
+            self._condition.notify()
+
+    # Return every waiting event, blocking for up to timeout seconds for one to arrive. Empty if none did
+    def get(self, timeout):
+        with self._condition:
+            if not self._events:
+                self._condition.wait(timeout)
+            events = list(self._events)
+            self._events.clear()
+        return events
+
+
+# Fans device state changes out to every subscriber of their topic, e.g ('meross', 'office', {'onoff': 1, ...})
+class EventBus:
+    def __init__(self, queue_size=100):
+        self.queue_size = queue_size
+        self._lock = threading.Lock()
+        self._subscriptions = set()
+
+    @property
+    def subscribers(self):
+        return len(self._subscriptions)
+
+    def subscribe(self, topics=None):
+        subscription = Subscription(topics, self.queue_size)
+        with self._lock:
+            self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def publish(self, topic, key, state):
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            if subscription.topics is None or topic in subscription.topics:
+                subscription.put((topic, key, state))
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+import threading
+from time import monotonic
+import metrics
+
+failure_threshold = 3  # consecutive failures after which a device is taken to be offline
+
+breakers = {}  # (resource, device) -> Breaker
+_lock = threading.Lock()
+
+
+# Tracks whether a device is reachable. After threshold consecutive failures the breaker opens and callers should fail
+# straight away instead of waiting out the device's timeout. An open breaker is only closed again by probe (a cheap
+# call returning True if the device answers) run from probe_all, or by a success reported from elsewhere
+class Breaker:
+    def __init__(self, probe, threshold=failure_threshold):
+        self.probe = probe
+        self.threshold = threshold
+        self.state = 'closed'  # closed, open, or half_open while a probe is running
+        self.failures = 0
+        self.changed = monotonic()
+        self._lock = threading.Lock()
+
+    def _set_state(self, state):
+        if state != self.state:
+            self.state = state
+            self.changed = monotonic()
+
+    def allow(self):
+        return self.state == 'closed'
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self._set_state('closed')
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self._set_state('open')
+
+    def check(self):
+        with self._lock:
+            if self.state != 'open':
+                return
+            self._set_state('half_open')
+        try:
+            healthy = self.probe()
+        except Exception:
+            healthy = False
+        if healthy:
+            self.success()
+        else:
+            with self._lock:
+                self._set_state('open')
+
+
+def breaker(resource, device, probe, **settings):
+    with _lock:
+        if (resource, device) not in breakers:
+            breakers[(resource, device)] = Breaker(probe, **settings)
+        return breakers[(resource, device)]
+
+
+# Probe every open breaker, run periodically from a Refresher
+def probe_all():
+    for item in list(breakers.values()):
+        item.check()
+
+
+# resource -> device -> state, consecutive failures and seconds in that state
+def report():
+    now = monotonic()
+    health = {}
+    for (resource, device), item in list(breakers.items()):
+        health.setdefault(resource, {})[device] = {'state': item.state, 'failures': item.failures,
+                                                   'since': round(now - item.changed, 1)}
+    return health
+
+
+metrics.Collector('restate_device_up', 'Whether the circuit breaker for a device is closed', 'gauge', ('resource', 'device'),
+                  lambda: [(key, int(item.state == 'closed')) for key, item in list(breakers.items())])
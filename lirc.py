@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+
+import os
+import socket
+import threading
+from time import monotonic
+import metrics
+
+socket_path = '/var/run/lirc/lircd'
+config_paths = ['/etc/lirc/lircd.conf', '/etc/lirc/lircd.conf.d']
+check_interval = 1  # seconds between checks of the lircd configuration for changes
+hold_timeout = 10  # seconds after which a held key is released if the client never sends a stop
+
+
+class LircError(Exception):
+    pass
+
+
+# A persistent connection to the lircd socket. Commands are written one at a time and their reply packet read back:
+# BEGIN, the echoed command, SUCCESS or ERROR, optionally DATA with a line count and lines, then END
+class LircConnection:
+    def __init__(self, path, timeout):
+        self.path = path
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._socket = None
+        self._buffer = b''
+
+    def _connect(self):
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.settimeout(self.timeout)
+        self._socket.connect(self.path)
+        self._buffer = b''
+
+    def close(self):
+        if self._socket is not None:
+            self._socket.close()
+        self._socket = None
+
+    def _readline(self):
+        while b'\n' not in self._buffer:
+            data = self._socket.recv(4096)
+            if not data:
+                raise ConnectionResetError('lircd closed the connection')
+            self._buffer += data
+        line, self._buffer = self._buffer.split(b'\n', 1)
+        return line.decode()
+
+    def _read_reply(self, command):
+        while True:
+            if self._readline() != 'BEGIN':
+                continue
+            echo = self._readline()
+            if echo != command:  # broadcast such as SIGHUP, not the reply to our command
+                while self._readline() != 'END':
+                    pass
+                continue
+            success = self._readline() == 'SUCCESS'
+            data = []
+            line = self._readline()
+            if line == 'DATA':
+                data = [self._readline() for _ in range(int(self._readline()))]
+                line = self._readline()
+            if line != 'END':
+                raise LircError(f'malformed reply to {command}')
+            if not success:
+                raise LircError(data[0] if data else f'{command} failed')
+            return data
+
+    def command(self, command):
+        remote = command.split()[1] if len(command.split()) > 1 else ''
+        with metrics.timed('LEDRemote', remote, 'lircd'), self._lock:
+            for attempt in range(2):
+                sent = False
+                try:
+                    if self._socket is None:
+                        self._connect()
+                    self._socket.sendall(f'{command}\n'.encode())
+                    sent = True
+                    return self._read_reply(command)
+                except (OSError, ValueError) as e:
+                    self.close()
+                    # Only resend when the stale connection failed before lircd could have acted on the command
+                    if attempt or (sent and not isinstance(e, ConnectionResetError)):
+                        raise LircError(f'{command}: {e}') from e
+
+
+# Talks to lircd directly over its unix socket instead of forking irsend, with one connection per remote so that
+# commands to a remote are serialized while different remotes do not wait on each other
+class Lirc:
+    def __init__(self, path=socket_path, timeout=2):
+        self.path = path
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._connections = {}
+        self._holds = {}  # remote -> Timer releasing a held key
+
+    def _connection(self, remote):
+        with self._lock:
+            if remote not in self._connections:
+                self._connections[remote] = LircConnection(self.path, self.timeout)
+            return self._connections[remote]
+
+    def send_once(self, remote, code, count=None):
+        self._connection(remote).command(f'SEND_ONCE {remote} {code}' + (f' {count}' if count else ''))
+
+    # Start repeating a key until send_stop, released automatically after timeout seconds
+    def send_start(self, remote, code, timeout=hold_timeout):
+        self._connection(remote).command(f'SEND_START {remote} {code}')
+        timer = threading.Timer(timeout, self._release, (remote, code))
+        timer.daemon = True
+        with self._lock:
+            previous, self._holds[remote] = self._holds.get(remote), timer
+        if previous is not None:
+            previous.cancel()
+        timer.start()
+
+    def send_stop(self, remote, code):
+        with self._lock:
+            timer = self._holds.pop(remote, None)
+        if timer is not None:
+            timer.cancel()
+        self._connection(remote).command(f'SEND_STOP {remote} {code}')
+
+    def _release(self, remote, code):
+        try:
+            self.send_stop(remote, code)
+        except LircError:
+            pass
+
+    # Raw keycode lines for remote, e.g '0000000000ff00ff KEY_POWER'
+    def list(self, remote):
+        return self._connection(remote).command(f'LIST {remote}')
+
+
+# Keycode tables for each lirc remote, read once and kept until the lircd configuration changes
+class Keycodes:
+    def __init__(self, client, paths=config_paths, interval=check_interval):
+        self.client = client
+        self.paths = paths
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._tables = {}
+        self._stamp = None
+        self._checked = None
+
+    # Modification times of the config files, directories change theirs when a file is added or removed
+    def _config_stamp(self):
+        stamp = []
+        for path in self.paths:
+            try:
+                stamp.append((path, os.stat(path).st_mtime_ns))
+                if os.path.isdir(path):
+                    stamp.extend((entry.path, entry.stat().st_mtime_ns) for entry in os.scandir(path))
+            except OSError:
+                stamp.append((path, None))
+        return stamp
+
+    # Return a dict of keycode name -> 8 digit hex value for remote
+    def get(self, remote):
+        with self._lock:
+            if self._checked is None or monotonic() - self._checked > self.interval:
+                self._checked = monotonic()
+                stamp = self._config_stamp()
+                if stamp != self._stamp:
+                    self._stamp = stamp
+                    self._tables = {}
+
+            if remote not in self._tables:
+                # Split to get a rough cut list of keycodes for configured device
+                raw_list = ' '.join(self.client.list(remote)).lower().split()
+                # Format the list of codes into a dict of name/hex_value
+                self._tables[remote] = dict([raw_list[i + 1], raw_list[i][-8:]] for i in range(0, len(raw_list), 2))
+            return self._tables[remote]
+
+
+client = Lirc()
+keycodes = Keycodes(client)
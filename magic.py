@@ -1,24 +1,94 @@
 #!/usr/bin/env python
 
 import socket
-from icmplib import ping
+import threading
+from time import monotonic
+from icmplib import ping, multiping, resolve, NameLookupError
 from string import hexdigits
+import metrics
+from single_flight import SingleFlight
 
 broadcast = "192.168.1.255"
 port = 9
+wake_resend = 5  # seconds between magic packets while waiting for a host to come up
+
+_socket = None  # broadcast socket shared by every power call
+_socket_lock = threading.Lock()
 
 
 def power(host, mac_address, broadcast=broadcast, port=port):
+    global _socket
     mac_address = ''.join(c for c in mac_address if c in hexdigits)
     target = bytes.fromhex('ff' * 6 + mac_address * 16)
-    try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        s.sendto(target, (broadcast, port))
-        return True
-    except socket.error:
-        return False
+    with _socket_lock:
+        try:
+            if _socket is None:
+                _socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                _socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            _socket.sendto(target, (broadcast, port))
+            return True
+        except socket.error:
+            if _socket is not None:
+                _socket.close()
+                _socket = None
+            return False
 
 
 def status(host, mac_address, count=1, timeout=0.1):
     return ping(host, count=count, timeout=timeout).is_alive
+
+
+# Keeps the up/down state of every wake-on-lan host in cache, refreshed by pinging them all at once in sweep()
+class Presence:
+    def __init__(self, hosts, cache, timeout=0.5):
+        self.hosts = list(hosts)
+        self.cache = cache
+        self.timeout = timeout
+        self._flight = SingleFlight('WakeHost')
+
+    def sweep(self):
+        addresses = {}
+        for host in self.hosts:
+            try:
+                addresses[host] = resolve(host)[0]
+            except NameLookupError:
+                self.cache.set(host, False)  # one unresolvable host must not fail the whole sweep
+        if not addresses:
+            return
+        with metrics.timed('WakeHost', 'all', 'multiping'):
+            results = multiping(list(addresses.values()), count=1, timeout=self.timeout)
+        for host, result in zip(addresses, results):
+            self.cache.set(host, result.is_alive)
+
+    def status(self, host, mac_address):
+        state = self.cache.get(host)
+        if state is None:
+            state = self._flight.do(host, self._ping, host, mac_address)
+        return state
+
+    def _ping(self, host, mac_address):
+        with metrics.timed('WakeHost', host, 'ping'):
+            state = status(host, mac_address)
+        self.cache.set(host, state)
+        return state
+
+    def power(self, host, mac_address):
+        self.cache.invalidate(host)
+        with metrics.timed('WakeHost', host, 'wol'):
+            return power(host, mac_address)
+
+    # Wake host and return only once it answers a ping, or False if deadline seconds pass first. The host is pinged
+    # back to back and the magic packet repeated every wake_resend seconds in case one was lost
+    def power_wait(self, host, mac_address, deadline):
+        self.cache.invalidate(host)
+        end = monotonic() + deadline
+        resend = 0
+        while monotonic() < end:
+            if monotonic() >= resend:
+                if not power(host, mac_address):
+                    return False
+                resend = monotonic() + wake_resend
+            if ping(host, count=1, timeout=max(0.05, min(self.timeout, end - monotonic()))).is_alive:
+                self.cache.set(host, True)
+                return True
+        return False
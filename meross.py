@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+
+import threading
+import requests
+import metrics
+import health
+from single_flight import SingleFlight
+from concurrent.futures import Future
+from uuid import uuid4
+from hashlib import md5
+from enum import Enum
+
+max_in_flight = 2  # requests a bulb is sent at once, the rest wait their turn
+
+
+class MerossDeviceType(Enum):
+    BULB = 0
+    SOCKET = 1
+
+
+# Renders the complete request body for each code once, leaving only the value to be spliced in per request. The
+# messageId, timestamp and sign never change for a device so the header is fixed
+class MessageBuilder:
+    def __init__(self, payloads):
+        self.messageId = str(uuid4())  # arbitrary string
+        self.timestamp = 0
+
+        self.sign = md5(f'{self.messageId}{self.timestamp}'.encode()).hexdigest()  # sign is md5 of messageId+timestamp
+
+        self.messages = {}  # code -> (bytes before the value, bytes after the value)
+        for code, (namespace, head, tail) in payloads.items():
+            method = 'GET' if code == 'status' else 'SET'
+            self.messages[code] = (f'{{"header": {{"messageId": "{self.messageId}", "method": "{method}", '
+                                   f'"namespace": "{namespace}", "payloadVersion": 1, "sign": "{self.sign}", '
+                                   f'"timestamp": {self.timestamp}}}, "payload": {head}'.encode(), f'{tail}}}'.encode())
+
+    def build(self, code, value=''):
+        head, tail = self.messages[code]
+        return head + str(value).encode() + tail
+
+
+_turn = object()  # tells a waiting light set that it is next to be sent
+
+
+# Collapses bursts of light sets (e.g from a slider) to the last value per code. A set is sent straight away unless one
+# of the same code is already in flight, in which case it waits to go next. A newer set arriving meanwhile takes its
+# place and the replaced request is answered without reaching the bulb
+class LightDebouncer:
+    def __init__(self, send):
+        self.send = send  # (code, value) -> (response, status)
+        self._lock = threading.Lock()
+        self._busy = set()  # codes with a set in flight
+        self._pending = {}  # code -> Future of the set waiting to go next
+
+    def set(self, code, value):
+        with self._lock:
+            if code in self._busy:
+                pending = self._pending.get(code)
+                if pending is not None:
+                    pending.set_result(({'message': 'Superseded'}, 200))
+                future = self._pending[code] = Future()
+            else:
+                self._busy.add(code)
+                future = None
+        if future is not None:
+            result = future.result()
+            if result is not _turn:
+                return result
+
+        try:
+            return self.send(code, value)
+        finally:
+            # Hand the code over to the set waiting behind us, if any, otherwise free it
+            with self._lock:
+                following = self._pending.pop(code, None)
+                if following is None:
+                    self._busy.discard(code)
+            if following is not None:
+                following.set_result(_turn)
+
+
+class Meross:
+    def __init__(self, name, device_type, pool, cache, max_in_flight=max_in_flight):
+        self.name = name
+        self.pool = pool
+        self.device_type = device_type
+        self.cache = cache
+        self._flight = SingleFlight('MerossDevice')
+        self.breaker = health.breaker('MerossDevice', name, self._probe)
+        self.lights = LightDebouncer(self._set)
+        self._in_flight = threading.Semaphore(max_in_flight)
+
+        self.payloads = {}  # code -> [namespace, payload text before the value, payload text after the value]
+        if device_type is MerossDeviceType.BULB or device_type is MerossDeviceType.SOCKET:
+            self.payloads['toggle'] = ['Appliance.Control.ToggleX', '{"togglex":{"onoff": ', '}}']
+            self.payloads['status'] = ['Appliance.System.All', '{}', '']
+        if device_type is MerossDeviceType.BULB:
+            self.payloads['luminance'] = ['Appliance.Control.Light', '{"light":{"capacity":4, "luminance": ', '}}']
+            self.payloads['temperature'] = ['Appliance.Control.Light', '{"light":{"capacity":2, "temperature": ', '}}']
+            self.payloads['rgb'] = ['Appliance.Control.Light', '{"light":{"capacity":1, "rgb": ', '}}']
+
+        self.builder = MessageBuilder(self.payloads)
+
+    def _post(self, message):
+        try:
+            with self._in_flight, metrics.timed('MerossDevice', self.name, 'http'):
+                request = self.pool.post('/config', headers={'Content-Type': 'application/json'}, data=message)
+        except requests.exceptions.RequestException:
+            self.breaker.failure()
+            return None
+        self.breaker.success()  # any answer at all means the device is reachable
+        if request.status_code != 200:
+            metrics.error('MerossDevice', self.name, 'http')
+            return None
+        return request
+
+    # Read the current state of the device over the LAN, refreshing the cache. Returns None on failure
+    def fetch_state(self):
+        if not self.breaker.allow():
+            return None
+        request = self._post(self.builder.build('status'))
+        if request is None:
+            return None
+        try:
+            req_json = request.json()['payload']['all']['digest']
+            # Construct a stripped down json object describing the bulbs current state
+            state = {}
+            if self.device_type is MerossDeviceType.BULB or self.device_type is MerossDeviceType.SOCKET:
+                state['onoff'] = req_json['togglex'][0]['onoff']
+            if self.device_type is MerossDeviceType.BULB:
+                state['rgb'] = f"{req_json['light']['rgb']:x}"  # convert returned decimal to hexstring e.g ff00ff
+                state['temperature'] = req_json['light']['temperature']
+                state['luminance'] = req_json['light']['luminance']
+        except (ValueError, KeyError, IndexError, TypeError):
+            return None
+        self.cache.set(self.name, state)
+        return dict(state)
+
+    # Cached state if it is younger than max_age, otherwise a live read shared with any other request waiting on one
+    def state(self, max_age=None):
+        state = self.cache.get(self.name, max_age)
+        if state is None:
+            state = self._flight.do(self.name, self.fetch_state)
+        return state
+
+    def _probe(self):
+        return self._post(self.builder.build('status')) is not None
+
+    def put(self, code, value=None, max_age=None):
+        if code not in self.payloads:
+            return {'message': 'Invalid code'}, 400
+        if not self.breaker.allow():  # known to be offline, fail now rather than wait out the timeout
+            return {'message': 'Device offline'}, 503
+
+        if self.payloads[code][0] == 'Appliance.Control.Light':
+            if value is None:  # must pass a value parameter when using Appliance.Control.Light namespace
+                return {'message': {'value': "variable required"}}, 400
+
+            if code == 'rgb':
+                try:
+                    value = int(value, 16)  # convert hex color code to int - e.g ff00ff
+                    if value > 0xffffff or value < 0x000000:
+                        return {'message': 'value not a valid hex color (000000 -ffffff)'}
+                except ValueError:
+                    return {'message': 'value not a valid hex color (000000 -ffffff)'}
+            else:
+                try:
+                    value = max(-1, min(int(value, 10), 100))  # Clamp to range -1 -100
+                except ValueError:
+                    return {'message': 'value not a valid integer (1-100)'}
+        else:
+            if value is None or code == 'status':
+                state = self.state(max_age)
+                if state is None:
+                    return {'message': 'Unexpected response'}, 500
+
+                if code == 'status':
+                    return state, 200
+                value = 1 - int(state['onoff'])  # store an inverted copy of the bulbs current onoff state
+
+            elif value == '0' or value == '1':
+                pass
+            else:
+                return {'message': 'value is not a valid integer (0-1)'}
+
+        if self.payloads[code][0] == 'Appliance.Control.Light':
+            return self.lights.set(code, value)
+        return self._set(code, value)
+
+    def _set(self, code, value):
+        if self._post(self.builder.build(code, value)) is None:
+            return {'message': 'Unexpected response'}, 500
+
+        # Fold what we just set into the cached state so the next status / toggle does not need to ask the bulb
+        if code == 'toggle':
+            self.cache.update(self.name, {'onoff': int(value)})
+        elif code == 'rgb':
+            self.cache.update(self.name, {'rgb': f"{value:x}"})
+        elif value >= 0:  # -1 leaves the bulbs setting untouched
+            self.cache.update(self.name, {code: value})
+        return {'message': 'Success'}, 200
+
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from time import perf_counter
+
+buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+registry = []  # every metric rendered by render(), in creation order
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values):
+    return ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+
+
+class Counter:
+    def __init__(self, name, description, labels):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self._lock = threading.Lock()
+        self._values = {}
+        registry.append(self)
+
+    def inc(self, *values, amount=1):
+        with self._lock:
+            self._values[values] = self._values.get(values, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} counter']
+        with self._lock:
+            lines += [f'{self.name}{{{_labels(self.labels, k)}}} {v}' for k, v in self._values.items()]
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, description, labels):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self._lock = threading.Lock()
+        self._series = {}  # label values -> [count per bucket..., count over the last bucket, sum]
+        registry.append(self)
+
+    def observe(self, seconds, *values):
+        index = bisect_left(buckets, seconds)
+        with self._lock:
+            series = self._series.get(values)
+            if series is None:
+                series = self._series[values] = [0] * (len(buckets) + 2)
+            series[index] += 1
+            series[-1] += seconds
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = [(k, list(v)) for k, v in self._series.items()]
+        for values, counts in series:
+            labels = _labels(self.labels, values)
+            total = 0
+            for bound, count in zip(buckets, counts):
+                total += count
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {total}')
+            total += counts[len(buckets)]
+            lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {total}')
+            lines.append(f'{self.name}_sum{{{labels}}} {counts[-1]}')
+            lines.append(f'{self.name}_count{{{labels}}} {total}')
+        return lines
+
+
+# Reports values that are owned elsewhere (e.g connection pool counters), read from func at scrape time
+class Collector:
+    def __init__(self, name, description, kind, labels, func):
+        self.name = name
+        self.description = description
+        self.kind = kind
+        self.labels = labels
+        self.func = func
+        registry.append(self)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.kind}']
+        lines += [f'{self.name}{{{_labels(self.labels, k)}}} {v}' for k, v in self.func()]
+        return lines
+
+
+latency = Histogram('restate_latency_seconds', 'Time spent per resource, device and phase', ('resource', 'device', 'phase'))
+errors = Counter('restate_errors_total', 'Failed calls per resource, device and phase', ('resource', 'device', 'phase', 'kind'))
+
+
+def error(resource, device, phase, kind='error'):
+    errors.inc(resource, device, phase, kind)
+
+
+# Time the enclosed block into the latency histogram, counting any exception that escapes it as an error or timeout
+@contextmanager
+def timed(resource, device, phase):
+    start = perf_counter()
+    try:
+        yield
+    except Exception as e:
+        # requests, pyserial, socket and asyncio each have their own timeout exceptions, all named as such
+        error(resource, device, phase, 'timeout' if 'timeout' in type(e).__name__.lower() else 'error')
+        raise
+    finally:
+        latency.observe(perf_counter() - start, resource, device, phase)
+
+
+def render():
+    return '\n'.join(line for metric in registry for line in metric.render()) + '\n'
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+import threading
+import bluetooth
+import metrics
+
+reply_size = 4  # Pico repeaters acknowledge every code with OK followed by a 2 byte terminator
+backoff_min = 0.5
+backoff_max = 30
+
+
+class RfcommError(Exception):
+    pass
+
+
+def rfcomm_connect(address, timeout):
+    sock = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
+    sock.connect((address, 1))
+    sock.settimeout(timeout)
+    return sock
+
+
+# One persistent serial bluetooth connection to a Pico repeater. Commands are serialized by a per link lock and any
+# failure drops the socket, which is then re-established in the background with exponential backoff
+class RfcommLink:
+    def __init__(self, address, timeout, connect=rfcomm_connect):
+        self.address = address
+        self.timeout = timeout
+        self.connect = connect
+        self._lock = threading.Lock()
+        self._state_lock = threading.Lock()
+        self._connected = threading.Event()
+        self._reconnecting = False
+        self._socket = None
+        self._buffer = b''
+        self._reconnect()
+
+    def _reconnect(self):
+        with self._state_lock:
+            if self._reconnecting:
+                return
+            self._reconnecting = True
+        threading.Thread(target=self._reconnect_loop, daemon=True).start()
+
+    def _reconnect_loop(self):
+        delay = backoff_min
+        while True:
+            try:
+                sock = self.connect(self.address, self.timeout)
+                break
+            except OSError:
+                self._connected.wait(delay)  # never set here, just an interruptible sleep
+                delay = min(delay * 2, backoff_max)
+        with self._state_lock:
+            self._socket, self._buffer = sock, b''
+            self._reconnecting = False
+        self._connected.set()
+
+    def _drop(self):
+        self._connected.clear()
+        with self._state_lock:
+            sock, self._socket = self._socket, None
+        if sock is not None:
+            try:
+                sock.close()
+            except OSError:
+                pass
+        self._reconnect()
+
+    @property
+    def connected(self):
+        return self._connected.is_set()
+
+    # Send a payload and return the repeaters reply. Reads pull in whatever has arrived rather than a byte per call
+    def send(self, payload, size=reply_size):
+        with self._lock:
+            if not self._connected.wait(self.timeout):
+                metrics.error('BluetoothRemote', self.address, 'rfcomm', 'timeout')
+                raise RfcommError('No connection')
+            try:
+                with metrics.timed('BluetoothRemote', self.address, 'rfcomm'):
+                    self._socket.send(payload)
+                    while len(self._buffer) < size:
+                        data = self._socket.recv(64)
+                        if not data:
+                            raise ConnectionResetError('peer closed the connection')
+                        self._buffer += data
+            except OSError:
+                received = self._buffer
+                self._drop()  # the stream can no longer be trusted to be in step, start over on a new connection
+                raise RfcommError('Unexpected response' if received else 'No response')
+            reply, self._buffer = self._buffer[:size], self._buffer[size:]
+            return reply
+
+
+# Every repeater gets its own link so a slow or missing one does not hold up the rest
+class RfcommManager:
+    def __init__(self, connect=rfcomm_connect):
+        self.connect = connect
+        self._lock = threading.Lock()
+        self._links = {}
+
+    def get(self, address, timeout):
+        with self._lock:
+            if address not in self._links:
+                self._links[address] = RfcommLink(address, timeout, self.connect)
+            return self._links[address]
+
+
+links = RfcommManager()
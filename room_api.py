@@ -1,37 +1,55 @@
 #!/usr/bin/env python3
 
-from flask import Flask
+from flask import Flask, Response, request, g
 from flask_restful import Api, Resource, reqparse
-from werkzeug.exceptions import NotFound
-from serial import Serial, SerialException
-import subprocess as shell
+from werkzeug.exceptions import NotFound, HTTPException
+from serial import SerialException
 import re
+import json
 from ntfy import notify
-import bluetooth
 import requests
-import httpx
 import asyncio
-from uuid import uuid4
-import json
-from hashlib import md5
-from string import Template
-from enum import Enum
+from functools import partial
+from time import monotonic, perf_counter
 
 # Local imports
 import magic
+import lirc
+import rfcomm
+import meross
+import alerts
+from meross import MerossDeviceType
+from state_cache import StateCache, Refresher
+from event_bus import EventBus
+from engine import Engine
+from serial_worker import SerialWorker
+import sessions
+import metrics
+import health
+import discovery
 from tvcom.serial_lookup import SerialLookup
 
 
-class MerossDeviceType(Enum):
-    BULB = 0
-    SOCKET = 1
-
-
 app = Flask(__name__)
 api = Api(app)
 base_path = "/api/v1.0/"
 serial_port = '/dev/ttyUSB0'
 timeout = 5
+meross_refresh_interval = 30  # seconds between background reads of every meross device
+meross_state_max_age = 60  # cached meross state older than this forces a live read
+tvcom_state_max_age = 30  # relative tvcom changes older than this read the slider from the tv first
+presence_interval = 10  # seconds between pings of every magic host
+wake_wait_max = 120  # longest a power request may wait for its host to come up, the request holds a thread throughout
+health_probe_interval = 10  # seconds between probes of devices that have been marked offline
+tvcom_poll_interval = 10  # seconds between status reads of every tvcom setting, only while someone is subscribed
+subscriber_limit = 4  # open subscriptions, each holds a server thread for as long as it is connected
+keepalive_interval = 15  # seconds between comments sent down an idle subscription
+engine_concurrency = 16  # blocking device calls the shared engine will run at once
+alert_dedup_window = 60  # seconds a repeated alert title/message is ignored for
+alert_batch_window = 2  # seconds alerts are gathered for before being sent as one notification
+alert_rate_limits = {None: (6, 60), '2': (20, 60)}  # priority -> (notifications, per seconds), None for the rest
+meross_max_in_flight = 2  # requests sent to one bulb at a time
+meross_pool = {'pool_size': 2, 'connect_timeout': 1.5, 'read_timeout': 1.5}  # defaults, override per device with a 'pool' key
 meross_devices = {
     "office": {
         'hostname': "192.168.1.140",
@@ -82,15 +100,39 @@ meross_devices = {
         "device_type": MerossDeviceType.SOCKET
     }
 }
+scenes = {
+    "goodnight": [{"endpoint": "meross", "hosts": ",".join(k for k, v in meross_devices.items()
+                                                         if v['device_type'] is MerossDeviceType.BULB),
+                   "code": "toggle", "value": "0"}],
+    "movie_night": [{"endpoint": "meross", "hosts": "hall_down,kitchen,kitchen_2", "code": "toggle", "value": "0"},
+                    {"endpoint": "meross/livingroom", "code": "luminance", "value": "10"},
+                    {"endpoint": "meross/livingroom_lamp", "code": "temperature", "value": "0"},
+                    {"endpoint": "meross/livingroom_lamp", "code": "luminance", "value": "30"}]
+}
 magic_hosts = {
         "pc": "2c:f0:5d:56:40:43",
     "shitcube": "e0:d5:5e:3c:2f:6c"
 }
 
 
+# Name of the Resource class serving the current request, used to label metrics
+def resource_name():
+    view = app.view_functions.get(request.endpoint)
+    return getattr(view, 'view_class', None) and view.view_class.__name__
+
+
+class RequestParser(reqparse.RequestParser):
+    def parse_args(self, *args, **kwargs):
+        with metrics.timed(resource_name(), request.endpoint, 'parse'):
+            return super().parse_args(*args, **kwargs)
+
+
 class SendAlert(Resource):
-    def __init__(self):
-        self.reqparse = reqparse.RequestParser()
+    transport = 'ntfy'
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.reqparse = RequestParser()
         self.reqparse.add_argument('message', required=True, help="variable required")
         self.reqparse.add_argument('title')
         self.reqparse.add_argument('priority')
@@ -100,166 +142,147 @@ class SendAlert(Resource):
         args = self.reqparse.parse_args()
         # Assign a default value to title if nothing was recieved in request
         args['title'] = "flask" if args['title'] is None else args['title']
-        # Filter out None's from the dict and pass the cleaned dict directly to ntfy as kwargs
-        if notify(**dict(filter(lambda a: a[1] is not None, args.items()))) != 0:
-            return {'message': 'Unexpected response'}, 500
-        return {'message': 'Success'}, 200
+        # Hand the alert to the dispatcher, ntfy is called from its thread once any burst has been gathered
+        outcome = self.queue.submit(args['message'], args['title'], args['priority'], args['api_token'])
+        if outcome == 'full':
+            return {'message': 'Queue full'}, 503
+        return {'message': 'Duplicate' if outcome == 'duplicate' else 'Accepted'}, 202
 
 
-async def meross_multi_put(hosts, json, timeout):
-    async with httpx.AsyncClient() as client:
-        tasks = (client.put(f'http://localhost/api/v1.0/meross/{host}', headers={'Content-Type': 'application/json'}, timeout=timeout, json=json) for host in hosts)
-        return {req.url.path.split('/')[-1]: req.json() for req in await asyncio.gather(*tasks)}
-            
-
 class MerossDeviceBase(Resource):
 
-    def __init__(self, devices, timeout):
+    transport = 'meross'
+    fan_out = 'hosts'  # batch steps are split into one meross/<host> step per host
+
+    def __init__(self, devices, engine, timeout):
         self.timeout = timeout
-        self.devices = list(devices)
-        self.reqparse = reqparse.RequestParser()
+        self.devices = devices
+        self.engine = engine
+        self.reqparse = RequestParser()
 
+    @discovery.cached
     def get(self):
-        return {'endpoint': self.devices}, 200
+        return {'endpoint': list(self.devices)}, 200
 
     def put(self):
         self.reqparse.add_argument('hosts', required=True, help="variable required")
         self.reqparse.add_argument('code', required=True, help="variable required")
         self.reqparse.add_argument('value')
         args = self.reqparse.parse_args()
-        json = {'code': args['code'], 'value': args['value']} if args['value'] else {'code': args['code']}
 
         hosts = args['hosts'].split(',')
         if not all(host in self.devices for host in hosts):
             return {'message': 'Invalid hosts'}, 400
 
-        try:
-            return asyncio.run(meross_multi_put(hosts, json, self.timeout)), 200
-        except e:
-            return e, 500
-        
+        # Drive every device directly on the shared engine, each host reports its own result or timeout
+        results = self.engine.gather({host: partial(self.devices[host].put, args['code'], args['value'] or None) for host in hosts},
+                                     self.timeout)
+        for host, result in results.items():
+            if isinstance(result, asyncio.TimeoutError):
+                results[host] = {'message': 'Timeout'}
+            elif isinstance(result, Exception):
+                results[host] = {'message': 'Unexpected response'}
+            else:
+                results[host] = result[0]
+        return results, 200
 
 
-class MerossDevice(Resource):
-    def __init__(self, host, device_type, timeout):
-        self.reqparse = reqparse.RequestParser()
-        self.host = host
+class MerossStatus(Resource):
+
+    transport = 'meross'
+
+    def __init__(self, devices, engine, timeout):
         self.timeout = timeout
-        self.device_type = device_type
+        self.devices = devices
+        self.engine = engine
+        self.reqparse = RequestParser()
+
+    def describe(self, name, result):
+        if result is None and not self.devices[name].breaker.allow():
+            return {'message': 'Device offline'}
+        if isinstance(result, asyncio.TimeoutError):
+            return {'message': 'Timeout'}
+        if result is None or isinstance(result, Exception):
+            return {'message': 'Unexpected response'}
+        return result
+
+    # State of every device, read concurrently. Streamed a device at a time as NDJSON or server-sent events when asked
+    # for by format or the Accept header, otherwise one JSON object once every device has answered or timed out
+    def get(self):
+        self.reqparse.add_argument('format', choices=('json', 'ndjson', 'sse'), location='args')
+        self.reqparse.add_argument('max_age', type=float, location='args')
+        args = self.reqparse.parse_args()
+        accept = request.headers.get('Accept', '')
+        response_format = args['format'] or ('sse' if 'text/event-stream' in accept else
+                                             'ndjson' if 'application/x-ndjson' in accept else 'json')
 
-        self.messageId = str(uuid4())  # arbitrary string
-        self.timestamp = 0
+        results = self.engine.as_completed({name: partial(device.state, args['max_age'])
+                                            for name, device in self.devices.items()}, self.timeout)
+        if response_format == 'json':
+            results = dict(results)
+            return {name: self.describe(name, results[name]) for name in self.devices}, 200
 
-        self.sign = md5(f'{self.messageId}{self.timestamp}'.encode()).hexdigest()  # sign is md5 of messageId+timestamp
+        def stream():
+            for name, result in results:
+                state = self.describe(name, result)
+                line = json.dumps({'device': name, **state} if 'message' in state else {'device': name, 'state': state})
+                yield f'event: state\ndata: {line}\n\n' if response_format == 'sse' else f'{line}\n'
+            if response_format == 'sse':
+                yield 'event: end\ndata: {}\n\n'
 
-        self.base_json = Template('{ "header": { "messageId": "${messageId}",  "method": "${method}", \
-                                   "namespace": "${namespace}", "payloadVersion": 1, "sign": "${sign}",\
-                                   "timestamp": ${timestamp} }, "payload": ${payload}}')
+        return Response(stream(), content_type='text/event-stream' if response_format == 'sse' else 'application/x-ndjson',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
-        self.payloads = {}
-        if device_type is MerossDeviceType.BULB or device_type is MerossDeviceType.SOCKET:
-            self.payloads['toggle'] = ['Appliance.Control.ToggleX', Template('{"togglex":{"onoff": ${value}}}')]
-            self.payloads['status'] = ['Appliance.System.All', '{}']
-        if device_type is MerossDeviceType.BULB:
-            self.payloads['luminance'] = ['Appliance.Control.Light', Template('{"light":{"capacity":4, "luminance": ${value}}}')]
-            self.payloads['temperature'] = ['Appliance.Control.Light', Template('{"light":{"capacity":2, "temperature": ${value}}}')]
-            self.payloads['rgb'] = ['Appliance.Control.Light', Template('{"light":{"capacity":1, "rgb": ${value}}}')]
 
+class MerossDevice(Resource):
+    transport = 'meross/{endpoint}'
+
+    def __init__(self, device):
+        self.reqparse = RequestParser()
+        self.device = device
+
+    @discovery.cached
     def get(self):
-        return {"codes": list(self.payloads.keys())}, 200
+        return {"codes": list(self.device.payloads.keys())}, 200
 
     def put(self):
         self.reqparse.add_argument('code', required=True, help="variable required")
         self.reqparse.add_argument('value')
+        self.reqparse.add_argument('max_age', type=float)  # override how stale a cached state may be, 0 forces a live read
         args = self.reqparse.parse_args()
-
-        if args['code'] not in self.payloads:
-            return {'message': 'Invalid code'}, 400
-
-        value = None
-        if self.payloads[args['code']][0] == 'Appliance.Control.Light':
-            if args['value'] is None:  # must pass a value parameter when using Appliance.Control.Light namespace
-                return {'message': {'value': "variable required"}}, 400
-
-            if args['code'] == 'rgb':
-                try:
-                    value = int(args['value'], 16)  # convert hex color code to int - e.g ff00ff
-                    if value > 0xffffff or value < 0x000000:
-                        return {'message': 'value not a valid hex color (000000 -ffffff)'}
-                except ValueError:
-                    return {'message': 'value not a valid hex color (000000 -ffffff)'}
-            else:
-                try:
-                    value = max(-1, min(int(args['value'], 10), 100))  # Clamp to range -1 -100
-                except ValueError:
-                    return {'message': 'value not a valid integer (1-100)'}
-        else:
-            if args['value'] is None or args['code'] == 'status':
-                # Retrieve current state of bulb
-                payload = self.payloads['status'][1]
-                try:
-                    request = requests.post(f'http://{self.host}/config', headers={'Content-Type': 'application/json'}, timeout=self.timeout,
-                                            json=json.loads(self.base_json.substitute(messageId=self.messageId, method='GET',
-                                                                                      namespace=self.payloads['status'][0], sign=self.sign,
-                                                                                      timestamp=self.timestamp, payload=payload)))
-                except requests.exceptions.RequestException as e:
-                    return {'message': 'Unexpected response'}, 500
-
-                if request.status_code != 200:
-                    return {'message': 'Unexpected response'}, 500
-
-                req_json = request.json()['payload']['all']['digest']
-                if args['code'] == 'status':
-                    # Construct a stripped down json object describing the bulbs current state
-                    ret_json = {}
-                    if self.device_type is MerossDeviceType.BULB or self.device_type is MerossDeviceType.SOCKET:
-                        ret_json['onoff'] = req_json['togglex'][0]['onoff']
-                    if self.device_type is MerossDeviceType.BULB:
-                        ret_json['rgb'] = f"{req_json['light']['rgb']:x}"  # convert returned decimal to hexstring e.g ff00ff
-                        ret_json['temperature'] = req_json['light']['temperature']
-                        ret_json['luminance'] = req_json['light']['luminance']
-                    return ret_json, 200
-                else:
-                    value = 1 - int(req_json['togglex'][0]['onoff'])  # store an inverted copy of the bulbs current onoff state
-
-            elif args['value'] == '0' or args['value'] == '1':
-                value = args['value']
-            else:
-                return {'message': 'value is not a valid integer (0-1)'}
-
-        # Substitute parsed value into payload, and then substitute the payload and other required fields into base_json before
-        # sending the constructed json on to the bulb
-        payload = self.payloads[args['code']][1].substitute(value=value)
-        try:
-            request = requests.post(f'http://{self.host}/config', headers={'Content-Type': 'application/json'}, timeout=self.timeout,
-                                    json=json.loads(self.base_json.substitute(messageId=self.messageId, method='SET',
-                                                                              namespace=self.payloads[args['code']][0], sign=self.sign,
-                                                                              timestamp=self.timestamp, payload=payload)))
-        except requests.exceptions.RequestException as e:
-            return {'message': 'Unexpected response'}, 500
-        if request.status_code != 200:
-            return {'message': 'Unexpected response'}, 500
-        return {'message': 'Success'}, 200
+        return self.device.put(args['code'], args['value'], args['max_age'])
 
 
 class WakeHost(Resource):
-    def __init__(self, host, mac_address):
+    transport = 'wol/{endpoint}'
+
+    def __init__(self, host, mac_address, presence):
         self.host = host
         self.mac_address = mac_address
-        self.reqparse = reqparse.RequestParser()
+        self.presence = presence
+        self.reqparse = RequestParser()
         self.codes = ['power', 'status']
         # super().__init__()
 
+    @discovery.cached
     def get(self):
         return {"code": self.codes}, 200
 
     def put(self):
         self.reqparse.add_argument('code', required=True, help="variable required")
+        self.reqparse.add_argument('wait', type=float)  # with power, seconds to wait for the host to come up
         args = self.reqparse.parse_args()
         if args['code'] not in self.codes:
             return {'message': 'Invalid code'}, 400
+        if args['wait'] is not None and not 0 <= args['wait'] <= wake_wait_max:
+            return {'message': f'wait not a valid number of seconds (0-{wake_wait_max})'}, 400
+
+        if args['code'] == 'power' and args['wait']:
+            if not self.presence.power_wait(self.host, self.mac_address, args['wait']):
+                return {'message': 'Timeout'}, 504
+            return {'message': 'Success'}, 200
 
-        state = getattr(magic, args['code'])(self.host, self.mac_address)
+        state = getattr(self.presence, args['code'])(self.host, self.mac_address)
 
         if args['code'] == "status":
             return {'status': 'on' if state else 'off'}, 200
@@ -270,31 +293,34 @@ class WakeHost(Resource):
 
 
 class LEDRemote(Resource):
+    transport = 'lircd/{endpoint}'
+
     def __init__(self, device_name):
         self.device_name = device_name
-        self.reqparse = reqparse.RequestParser()
+        self.reqparse = RequestParser()
         # super().__init__()
 
     def get(self):
-        # Run irsend to get a raw list of keycodes for self.device_name
-        raw_list = shell.check_output(["irsend", "list", self.device_name, ""])
-
-        # Format keycodes; convert to lowercase string, split into a list and subset
-        decoded_list = raw_list.decode("utf-8").lower().split()[1::2]
-
-        return {"code": decoded_list}, 200
+        return {"code": list(lirc.keycodes.get(self.device_name).keys())}, 200
 
     def put(self):
         # Ensure that a 'code' var has been passed in the request
         self.reqparse.add_argument('code', required=True, help="variable required")
+        self.reqparse.add_argument('hold', choices=('start', 'stop'), help="start or stop")  # repeat the key until stopped
         args = self.reqparse.parse_args()
         # Check that the passed code is in the list that our get method returns
-        if args['code'] not in self.get()[0]['code']:
+        if args['code'] not in lirc.keycodes.get(self.device_name):
             return {'message': 'Invalid code'}, 400
 
-        # Check return code of our irsend command to catch failure.
-        if shell.call(["irsend", "send_once", self.device_name, args['code']]) != 0:
-            return {'message': 'Non zero return code'}, 500
+        try:
+            if args['hold'] == 'start':
+                lirc.client.send_start(self.device_name, args['code'])
+            elif args['hold'] == 'stop':
+                lirc.client.send_stop(self.device_name, args['code'])
+            else:
+                lirc.client.send_once(self.device_name, args['code'])
+        except lirc.LircError:
+            return {'message': 'Unexpected response'}, 500
 
         return {'message': 'Success'}, 200
 
@@ -303,38 +329,24 @@ class BluetoothRemoteBase(Resource):
     def __init__(self, devices):
         self.devices = devices
 
+    @discovery.cached
     def get(self):
         return {'endpoint': self.devices}, 200
 
 
 class BluetoothRemote(Resource):
+    transport = 'rfcomm/{endpoint}'
+
     def __init__(self, lirc_device, serial, timeout):
         self.serial = serial
         self.lirc_device = lirc_device
         self.timeout = timeout
+        self.link = rfcomm.links.get(self.serial, self.timeout)  # persistent socket per repeater
+        self.breaker = health.breaker('BluetoothRemote', self.serial, lambda link=self.link: link.connected)
 
-        global active_btsocket  # persistant socket
-        try:
-            if active_btsocket.getpeername()[0] != self.serial:  # serial device changed
-                self._init_socket()
-        except:
-            self._init_socket()
-        self.socket = active_btsocket
-
-        # Run irsend and split to get a rough cut list list of keycodes for configured device
-        raw_list = shell.check_output(["irsend", "list", self.lirc_device, ""]).decode("utf-8").lower().split()
-        # Format the list of codes into a dict of name/hex_value
-        self.codes = dict([raw_list[i + 1], raw_list[i][-8:]]for i in range(0, len(raw_list), 2))
-
-        self.reqparse = reqparse.RequestParser()
-
-    # (Re)establish connection to a serial bluetooth module
-    def _init_socket(self):
-        global active_btsocket
-        active_btsocket.close()
-        active_btsocket = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
-        active_btsocket.connect((self.serial, 1))
-        active_btsocket.settimeout(self.timeout)
+        self.codes = lirc.keycodes.get(self.lirc_device)
+
+        self.reqparse = RequestParser()
 
     def get(self):
         return {"code": list(self.codes.keys())}, 200
@@ -347,41 +359,39 @@ class BluetoothRemote(Resource):
         if args['code'] not in self.codes:
             return {'message': 'Invalid code'}, 400
 
+        if not self.breaker.allow():  # the link has been down for a while, do not wait for it to come back
+            return {'message': 'Device offline'}, 503
+
         try:
-            # send 8 digit hex string to device
-            self.socket.send(f"{self.codes.get(args['code'])}\r".encode())
-            # Build a 4 byte response from return data, blocking on each byte
-            response = b''
-            while len(response) < 4:
-                data = self.socket.recv(1)
-                if not data:
-                    break
-                response += data
-
-            if len(response) != 4 or response[:2] != b'OK':
-                if len(response) == 0:
-                    return {'message': "No response"}, 500
-                else:
-                    return {'message': "Unexpected response"}, 500
-            return {'message': 'Success'}, 200
-        except:
+            # send 8 digit hex string to device and wait for its 4 byte acknowledgement
+            response = self.link.send(f"{self.codes.get(args['code'])}\r".encode())
+        except rfcomm.RfcommError as e:
+            self.breaker.failure()
+            return {'message': str(e)}, 500
+        self.breaker.success()
+
+        if response[:2] != b'OK':
             return {'message': "Unexpected response"}, 500
+        return {'message': 'Success'}, 200
 
 
 class TvComBase(Resource):
 
+    @discovery.cached
     def get(self):
         return {'endpoint': ['{}'.format(i.long_name) for i in SerialLookup.lookups]}, 200
 
 
 class TvCom(Resource):
 
-    def __init__(self, serial_port, serial_timeout, instance):
+    transport = 'serial'
+
+    def __init__(self, worker, instance):
         self.instance = instance
-        self.port = serial_port
-        self.timeout = serial_timeout
-        self.reqparse = reqparse.RequestParser()
+        self.worker = worker
+        self.reqparse = RequestParser()
 
+    @discovery.cached
     def get(self):
         # Extract list of values from dictionary
         code_list = [self.instance.lookup_table[k] for k in self.instance.lookup_table.keys()]
@@ -391,19 +401,11 @@ class TvCom(Resource):
                 code_list.append("{}".format(i))
         return {"code": code_list}, 200
 
-    def serial_comm(self, serial, key_code):
-        serial.write(f"{self.instance.name} 00 {self.instance.get_keycode(key_code)}\r".encode())
-        response = serial.read(10).decode()
-        success = True if response[5:7] == "OK" else False
-        payload = self.instance.get_desc(response[7:9])
-        print(success, payload)
-        return success, payload 
-
+    def serial_comm(self, key_code):
+        return self.worker.submit(self.instance, key_code)
 
     def put(self):
         try:
-            serial = Serial(self.port, timeout=self.timeout)
-
             self.reqparse.add_argument('code', required=True, help="variable required")
             args = self.reqparse.parse_args()
             # If 'code' var was not in request OR (if 'code' var is not in our list of valid codes AND is not a slider)
@@ -413,14 +415,9 @@ class TvCom(Resource):
                 return {'message': 'Invalid code'}, 400
 
             if self.instance.is_slider and re.match("^[\+-][0-9]{1,3}$", args['code']):
-                success, payload = self.serial_comm(serial, 'status')
-
-                if not success:
-                    return {'message': "Unexpected response"}, 500
-
-                args['code'] = payload + int(args['code'])
-
-            success, payload = self.serial_comm(serial, args['code'])
+                success, payload = self.worker.adjust(self.instance, int(args['code']))
+            else:
+                success, payload = self.serial_comm(args['code'])
 
             if not success:
                 return {'message': "Unexpected response"}, 500
@@ -431,18 +428,19 @@ class TvCom(Resource):
 
         except SerialException:
             return {'message': "Unexpected response"}, 500
-        finally:
-            serial.close()
+
 
 class Snowdon(Resource):
 
-    def __init__(self, host, port, timeout):
-        self.host = host
-        self.port = port
-        self.timeout = timeout
-        self.reqparse = reqparse.RequestParser()
+    transport = 'snowdon'
+
+    def __init__(self, pool, breaker):
+        self.pool = pool
+        self.breaker = breaker
+        self.reqparse = RequestParser()
         self.codes = ["status", "power", "mute", "volume_up", "volume_down", "previous", "next", "play_pause", "input", "treble_up", "treble_down", "bass_up", "bass_down", "pair", "flat", "music", "dialog", "movie"]
 
+    @discovery.cached
     def get(self):
         return self.codes, 200
 
@@ -452,56 +450,318 @@ class Snowdon(Resource):
 
         if 'code' not in args or args['code'] not in self.codes:
             return {'status': 'Invalid code'}, 400
+        if not self.breaker.allow():  # host is powered off, fail now rather than wait out the 10 second timeout
+            return {'status': 'Device offline'}, 503
         try:
-            request = requests.put(f'http://{self.host}:{self.port}/?code={args["code"]}', timeout=self.timeout)
+            with metrics.timed('Snowdon', self.pool.host, 'http'):
+                response = self.pool.put(f'/?code={args["code"]}')
         except requests.exceptions.RequestException as e:
+            self.breaker.failure()
             return {'status': 'Unexpected response'}, 500
+        self.breaker.success()
 
-        if request.status_code != 200:
+        if response.status_code != 200:
+            metrics.error('Snowdon', self.pool.host, 'http')
             return {'status': 'Unexpected response'}, 500
 
-        return request.json(), 200
+        return response.json(), 200
+
+
+# Run a command against one of our own resources in-process, returning its status code and json body
+def dispatch(path, args):
+    with app.test_request_context(path, method='PUT', json=args):
+        response = app.full_dispatch_request()
+    return response.status_code, response.get_json()
+
+
+def resource_class(path):
+    try:
+        endpoint, _ = app.url_map.bind('').match(path, method='PUT')
+    except HTTPException:
+        return None, None
+    return endpoint, app.view_functions[endpoint].view_class
+
+
+# Each resource declares the transport its commands travel over; steps sharing a transport run in order while
+# independent transports run in parallel
+def transport_lane(path):
+    endpoint, view_class = resource_class(path)
+    transport = getattr(view_class, 'transport', None)
+    return transport.format(endpoint=endpoint) if transport else None
+
+
+def run_steps(engine, steps):
+    lanes = {}
+    results = [None] * len(steps)
+    for index, step in enumerate(steps):
+        path = f"{base_path}{step.get('endpoint', '')}"
+        args = {k: v for k, v in step.items() if k != 'endpoint'}
+        _, view_class = resource_class(path)
+        fan_out = getattr(view_class, 'fan_out', None)
+        if fan_out and args.get(fan_out):
+            # Split a step over several devices into one per device, so each part queues in that device's own lane
+            # behind any other step for it
+            parts = {name: f'{path}/{name}' for name in args[fan_out].split(',')}
+            if not all(transport_lane(part) for part in parts.values()):
+                results[index] = {'endpoint': step.get('endpoint'), 'status': 400, 'response': {'message': f'Invalid {fan_out}'}}
+                continue
+            part_args = {k: v for k, v in args.items() if k != fan_out}
+            results[index] = {'endpoint': step.get('endpoint'), 'status': 200, 'response': dict.fromkeys(parts), 'time': 0}
+            for name, part in parts.items():
+                lanes.setdefault(transport_lane(part), []).append(((index, name), partial(dispatch, part, part_args)))
+            continue
+
+        lane = transport_lane(path)
+        if lane is None:
+            results[index] = {'endpoint': step.get('endpoint'), 'status': 404, 'response': {'message': 'Invalid endpoint'}}
+            continue
+        lanes.setdefault(lane, []).append(((index, None), partial(dispatch, path, args)))
+
+    lane_results = engine.lanes({lane: [func for _, func in calls] for lane, calls in lanes.items()})
+    for lane, calls in lanes.items():
+        for ((index, name), _), (result, elapsed) in zip(calls, lane_results[lane]):
+            if isinstance(result, Exception):
+                status, response = 500, {'message': 'Unexpected response'}
+            else:
+                status, response = result
+            if name is None:
+                results[index] = {'endpoint': steps[index].get('endpoint'), 'status': status, 'response': response,
+                                  'time': round(elapsed, 4)}
+            else:  # one device of a split step, reported under its name like the resource itself would
+                results[index]['response'][name] = response
+                results[index]['time'] = max(results[index]['time'], round(elapsed, 4))
+    return results
+
+
+class Batch(Resource):
+    def __init__(self, engine):
+        self.engine = engine
+        self.reqparse = RequestParser()
+
+    def put(self):
+        # e.g {"steps": [{"endpoint": "meross/office", "code": "toggle", "value": "0"}, {"endpoint": "pc", "code": "power"}]}
+        self.reqparse.add_argument('steps', type=dict, action='append', location='json', required=True, help="variable required")
+        args = self.reqparse.parse_args()
+        start = monotonic()
+        results = run_steps(self.engine, args['steps'])
+        return {'steps': results, 'time': round(monotonic() - start, 4)}, 200
+
+
+class SceneBase(Resource):
+    def __init__(self, scenes):
+        self.scenes = list(scenes)
+
+    @discovery.cached
+    def get(self):
+        return {'endpoint': self.scenes}, 200
+
+
+class Scene(Resource):
+    def __init__(self, steps, engine):
+        self.steps = steps
+        self.engine = engine
+
+    @discovery.cached
+    def get(self):
+        return {'steps': self.steps}, 200
+
+    def put(self):
+        start = monotonic()
+        results = run_steps(self.engine, self.steps)
+        return {'steps': results, 'time': round(monotonic() - start, 4)}, 200
+
+
+class Subscribe(Resource):
+    def __init__(self, bus, caches):
+        self.bus = bus
+        self.caches = caches  # topic -> StateCache, replayed to each new subscriber
+        self.reqparse = RequestParser()
+
+    @staticmethod
+    def event(topic, key, state):
+        return f"event: {topic}\ndata: {json.dumps({'device': key, 'state': state})}\n\n"
+
+    # Server-sent events for every change of device state, starting with whatever state is already known. Changes come
+    # from command results and the shared background pollers, so clients no longer need to poll devices themselves
+    def get(self):
+        self.reqparse.add_argument('topics', location='args', help="comma separated list of " + ','.join(self.caches))
+        args = self.reqparse.parse_args()
+        topics = set(args['topics'].split(',')) if args['topics'] else set(self.caches)
+        if not topics <= set(self.caches):
+            return {'message': 'Invalid topics'}, 400
+        if self.bus.subscribers >= subscriber_limit:
+            return {'message': 'Too many subscribers'}, 503
+
+        subscription = self.bus.subscribe(topics)
+
+        def stream():
+            try:
+                yield ': connected\n\n'  # get the headers out now rather than with the first event
+                for topic in topics:
+                    for key, state in self.caches[topic].items():
+                        yield self.event(topic, key, state)
+                while True:
+                    events = subscription.get(keepalive_interval)
+                    if not events:
+                        yield ': keepalive\n\n'
+                    for topic, key, state in events:
+                        yield self.event(topic, key, state)
+            finally:
+                self.bus.unsubscribe(subscription)
+
+        return Response(stream(), content_type='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+# Every endpoint with its methods and, where it has one, its discovery response, so clients can learn the whole API in
+# one round trip
+class Catalog(Resource):
+    precompute_last = True
+
+    @discovery.cached
+    def get(self):
+        catalog = {}
+        for rule in app.url_map.iter_rules():
+            if rule.endpoint == 'static':
+                continue
+            entry = catalog[rule.rule] = {'methods': sorted(rule.methods - {'HEAD', 'OPTIONS'})}
+            document = discovery.documents.get(rule.endpoint)
+            if document is not None:
+                entry['get'] = document.body
+        return catalog, 200
+
+
+class Health(Resource):
+    def get(self):
+        return health.report(), 200
+
+
+class Pools(Resource):
+    def get(self):
+        return sessions.stats(), 200
+
 
 class Root(Resource):
     def __init__(self, rules):
         self.rules = rules
 
+    @discovery.cached
     def get(self):
         return {'endpoint': [r for r in self.rules]}, 200
 
 
+@app.before_request
+def start_timer():
+    g.start = perf_counter()
+
+
+@app.after_request
+def record_request(response):
+    resource = resource_name()
+    if resource is not None and 'start' in g:
+        metrics.latency.observe(perf_counter() - g.start, resource, request.endpoint, 'request')
+        if response.status_code >= 500:
+            metrics.error(resource, request.endpoint, 'request')
+    return response
+
+
+@app.route('/metrics')
+def handle_metrics():
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 @app.errorhandler(NotFound)
 def handle_notfound(e):
     return {'message': e.name}, 404
 
 
 # ntfy
-api.add_resource(SendAlert, '{0}{1}'.format(base_path, "alert"), endpoint='alert')
+alert_queue = alerts.AlertQueue(notify, alert_dedup_window, alert_batch_window, alert_rate_limits)
+api.add_resource(SendAlert, '{0}{1}'.format(base_path, "alert"), endpoint='alert',
+                 resource_class_kwargs={'queue': alert_queue})
+metrics.Collector('restate_alert_queue_depth', 'Alerts waiting to be sent', 'gauge', (),
+                  lambda: [((), alert_queue.depth)])
 
 # Define base resource that will allow a GET for serial objects
 api.add_resource(TvComBase, '{0}{1}'.format(base_path, "tvcom"), endpoint='tvcom')
 
-# Define api endpoints for each serial object
+# Define api endpoints for each serial object, all sharing the one worker that owns the serial port
+# Device state changes seen in any cache are pushed to subscribers
+bus = EventBus()
+
+tvcom_state = StateCache(max_age=tvcom_state_max_age, on_change=partial(bus.publish, 'tvcom'))
+tvcom_worker = SerialWorker(serial_port, timeout, tvcom_state)
 for instance in SerialLookup.lookups:
     name = instance.long_name
     api.add_resource(TvCom, '{0}{1}{2}'.format(base_path, "tvcom/", name), endpoint=name,
                      resource_class_kwargs={'instance': instance,
-                                            'serial_port': serial_port,
-                                            'serial_timeout': timeout})
+                                            'worker': tvcom_worker})
+
+
+# Poll the tv only while someone is subscribed, otherwise the serial port is left to commands
+def poll_tvcom():
+    if not bus.subscribers:
+        return
+    for instance in SerialLookup.lookups:
+        try:
+            tvcom_worker.submit(instance, 'status')
+        except SerialException:
+            pass
+
+
+tvcom_refresher = Refresher(tvcom_poll_interval, poll_tvcom)
+presence = magic.Presence(magic_hosts.keys(), StateCache(max_age=presence_interval * 2, on_change=partial(bus.publish, 'wol')))
+presence_refresher = Refresher(presence_interval, presence.sweep)
 for name, mac_address in magic_hosts.items():
     api.add_resource(WakeHost, '{0}{1}'.format(base_path, name), endpoint=name,
                      resource_class_kwargs={'host': name,
-                                            'mac_address': mac_address})
-
+                                            'mac_address': mac_address,
+                                            'presence': presence})
+
+engine = Engine(engine_concurrency)
+meross_state = StateCache(max_age=meross_state_max_age, on_change=partial(bus.publish, 'meross'))
+meross_clients = {name: meross.Meross(name, settings.get('device_type'),
+                                     sessions.host_pool(name, settings.get('hostname'), **{**meross_pool, **settings.get('pool', {})}),
+                                     meross_state, meross_max_in_flight)
+                  for name, settings in meross_devices.items()}
+meross_refresher = Refresher(meross_refresh_interval,
+                             lambda: engine.gather({name: client.fetch_state for name, client in meross_clients.items()}, timeout))
 api.add_resource(MerossDeviceBase, '{0}{1}'.format(base_path, "meross"), endpoint='meross',
-        resource_class_kwargs={'devices': meross_devices.keys(), 'timeout': timeout})
-for name, settings in meross_devices.items():
+        resource_class_kwargs={'devices': meross_clients, 'engine': engine, 'timeout': timeout})
+api.add_resource(MerossStatus, '{0}{1}'.format(base_path, "meross/status"), endpoint='meross/status',
+                 resource_class_kwargs={'devices': meross_clients, 'engine': engine, 'timeout': timeout})
+for name, client in meross_clients.items():
     api.add_resource(MerossDevice, '{0}{1}{2}'.format(base_path, "meross/", name), endpoint=name,
-                     resource_class_kwargs={'host': settings.get('hostname'),
-                     'device_type': settings.get('device_type'), 'timeout': 1.5})
+                     resource_class_kwargs={'device': client})
 
+# No retries, codes such as power and volume_up are toggles or steps that a resend would apply twice
+snowdon_pool = sessions.host_pool('snowdon', '192.168.1.160:8080', pool_size=2, connect_timeout=2, read_timeout=10,
+                                  retries=0)
 api.add_resource(Snowdon, '{0}{1}'.format(base_path, "snowdon"), endpoint='snowdon',
-        resource_class_kwargs={'host': '192.168.1.160', 'port': 8080, 'timeout': 10})
+        resource_class_kwargs={'pool': snowdon_pool, 'breaker': health.breaker('Snowdon', 'snowdon', snowdon_pool.probe)})
+
+api.add_resource(Batch, '{0}{1}'.format(base_path, "batch"), endpoint='batch',
+                 resource_class_kwargs={'engine': engine})
+api.add_resource(SceneBase, '{0}{1}'.format(base_path, "scene"), endpoint='scene',
+                 resource_class_kwargs={'scenes': scenes.keys()})
+for name, steps in scenes.items():
+    api.add_resource(Scene, '{0}{1}{2}'.format(base_path, "scene/", name), endpoint=f'scene/{name}',
+                     resource_class_kwargs={'steps': steps, 'engine': engine})
+
+metrics.Collector('restate_pool_connections_total', 'HTTP connections opened, reused and retried per device pool', 'counter',
+                  ('device', 'connection'), lambda: [((name, kind), count) for name, stats in sessions.stats().items()
+                                                     for kind, count in stats.items()])
+
+api.add_resource(Subscribe, '{0}{1}'.format(base_path, "subscribe"), endpoint='subscribe',
+                 resource_class_kwargs={'bus': bus, 'caches': {'meross': meross_state, 'tvcom': tvcom_state,
+                                                               'wol': presence.cache}})
+metrics.Collector('restate_subscribers', 'Open state subscriptions', 'gauge', (), lambda: [((), bus.subscribers)])
+
+health_refresher = Refresher(health_probe_interval, health.probe_all)
+api.add_resource(Health, '{0}{1}'.format(base_path, "health"), endpoint='health')
+
+api.add_resource(Pools, '{0}{1}'.format(base_path, "pools"), endpoint='pools')
+api.add_resource(Catalog, '{0}{1}'.format(base_path, "catalog"), endpoint='catalog')
 
 regex = re.compile(f'^{base_path}[^/]*?$')
 rules = [i.rule for i in app.url_map.iter_rules()]
@@ -510,8 +770,22 @@ api.add_resource(Root, '/api/v1.0', endpoint='',
                  resource_class_kwargs={'rules': filtered_rules})
 api.add_resource(Root, '/api/v1.0/', endpoint='/',
                  resource_class_kwargs={'rules': filtered_rules})
+
+# Serialize every discovery response now that all routes are known
+discovery.precompute(app)
+
+
+# Threads that keep device state warm, started by whichever entry point serves the app
+def start_background():
+    meross_refresher.start()
+    presence_refresher.start()
+    tvcom_refresher.start()
+    health_refresher.start()
+
+
 if __name__ == '__main__':
     from waitress import serve
     from paste.translogger import TransLogger
+    start_background()
     serve(TransLogger(app, setup_console_handler=False), host='0.0.0.0', port=80, threads=10)#, threads=1)
     #app.run(host='0.0.0.0', port='80', debug=True)
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+# Serves the same resource tree as room_api.py from an asyncio server. Requests are handed to a thread pool chosen by
+# the transport the resource uses, so a hung device can only tie up its own transport's threads while every other
+# endpoint, including trivial GETs, keeps answering
+
+import io
+import sys
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import room_api
+
+executor_sizes = {
+    'api': 8,  # GETs and anything without a device transport
+    'serial': 4,
+    'meross': 12,
+    'rfcomm': 4,
+    'lircd': 4,
+    'wol': 4,
+    'snowdon': 2,
+    'ntfy': 2
+}
+executors = {name: ThreadPoolExecutor(max_workers=size, thread_name_prefix=name) for name, size in executor_sizes.items()}
+
+
+def executor_for(method, path):
+    if method == 'PUT':
+        lane = room_api.transport_lane(path)
+        if lane is not None:
+            return executors.get(lane.split('/')[0], executors['api'])
+    return executors['api']
+
+
+def wsgi_environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'].encode().decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+        'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name, value = name.decode('latin-1'), value.decode('latin-1')
+        if name == 'content-type':
+            environ['CONTENT_TYPE'] = value
+        elif name == 'content-length':
+            environ['CONTENT_LENGTH'] = value
+        else:
+            key = f"HTTP_{name.upper().replace('-', '_')}"
+            environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            room_api.start_background()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+
+    loop = asyncio.get_running_loop()
+    executor = executor_for(scope['method'], scope['path'])
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response['start'] = {'type': 'http.response.start', 'status': int(status.split(' ', 1)[0]),
+                             'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]}
+
+    result = await loop.run_in_executor(executor, room_api.app, wsgi_environ(scope, body), start_response)
+
+    # send() does nothing once the client has gone, so watch for the disconnect or an endless stream never ends
+    async def disconnected():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+    watcher = asyncio.ensure_future(disconnected())
+
+    # Pull the body a chunk at a time on the same pool so streamed responses are sent as they are produced
+    chunks = iter(result)
+    started = gone = False
+    try:
+        while True:
+            pending = loop.run_in_executor(executor, next, chunks, None)
+            await asyncio.wait({pending, watcher}, return_when=asyncio.FIRST_COMPLETED)
+            if not pending.done():
+                # Let the chunk being produced finish, a generator can not be closed while it is running
+                gone = True
+                await asyncio.wait({pending})
+                break
+            chunk = pending.result()
+            if chunk is None:
+                break
+            if not started:
+                await send(response['start'])
+                started = True
+            if chunk:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+    finally:
+        watcher.cancel()
+        if hasattr(result, 'close'):
+            await loop.run_in_executor(executor, result.close)
+    if gone:
+        return
+    if not started:
+        await send(response['start'])
+    await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host='0.0.0.0', port=80, lifespan='on')
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+import threading
+from collections import deque
+from concurrent.futures import Future
+from time import monotonic
+from serial import Serial, SerialException, SerialTimeoutException
+import metrics
+from single_flight import SingleFlight
+
+
+class Command:
+    def __init__(self, instance, key_code, delta, timeout):
+        self.instance = instance
+        self.key_code = key_code
+        self.delta = delta  # relative change for a slider, key_code is unused when set
+        self.timeout = timeout
+        self.deadline = monotonic() + timeout
+        self.future = Future()
+
+
+# Sole owner of the TV's serial port. The port is kept open and commands from every request thread are queued and run
+# one at a time, so writes and replies from concurrent requests can never interleave on the wire. The last value seen
+# for each instance is kept in cache so relative slider changes do not need a status round trip first
+class SerialWorker:
+    def __init__(self, port, timeout, cache):
+        self.port = port
+        self.timeout = timeout
+        self.cache = cache
+        self._serial = None
+        self._queue = deque()
+        self._condition = threading.Condition()
+        self._flight = SingleFlight('TvCom')
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    # Queue a command for a SerialLookup instance and block until its (success, payload) comes back. The command is
+    # abandoned if it has not reached the port within timeout seconds, and its reply must arrive within the same time
+    def submit(self, instance, key_code, timeout=None):
+        if key_code == 'status':  # concurrent reads of the same setting share one trip over the wire
+            return self._flight.do(instance.long_name, self._submit, instance, key_code, timeout)
+        return self._submit(instance, key_code, timeout)
+
+    def _submit(self, instance, key_code, timeout):
+        return self._enqueue(Command(instance, key_code, None, self.timeout if timeout is None else timeout))
+
+    # Move a slider by delta from its last known value. Adjustments to the same slider that are queued back to back are
+    # summed and sent as a single absolute set
+    def adjust(self, instance, delta, timeout=None):
+        return self._enqueue(Command(instance, None, delta, self.timeout if timeout is None else timeout))
+
+    def _enqueue(self, command):
+        with self._condition:
+            self._queue.append(command)
+            self._condition.notify()
+        return command.future.result()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._queue:
+                    self._condition.wait()
+                command = self._queue.popleft()
+                commands = [command]
+                if command.delta is not None:
+                    # Stop at the first other command for this slider so relative changes never jump an absolute one
+                    for pending in list(self._queue):
+                        if pending.instance is not command.instance:
+                            continue
+                        if pending.delta is None:
+                            break
+                        self._queue.remove(pending)
+                        commands.append(pending)
+
+            now = monotonic()
+            for expired in [c for c in commands if now > c.deadline]:
+                expired.future.set_exception(SerialTimeoutException('command expired in the queue'))
+                commands.remove(expired)
+            if not commands:
+                continue
+            command = commands[0]
+
+            try:
+                if command.delta is not None:
+                    result = self._adjust(command.instance, sum(c.delta for c in commands), command.timeout)
+                else:
+                    result = self._comm(command.instance, command.key_code, command.timeout)
+            except (SerialException, OSError) as e:
+                self._close()  # reopen the port for the next command
+                error = e if isinstance(e, SerialException) else SerialException(e)
+                for c in commands:
+                    c.future.set_exception(error)
+            except Exception as e:
+                for c in commands:
+                    c.future.set_exception(e)
+            else:
+                for c in commands:
+                    c.future.set_result(result)
+
+    def _close(self):
+        if self._serial is not None:
+            try:
+                self._serial.close()
+            except (SerialException, OSError):
+                pass
+        self._serial = None
+
+    def _comm(self, instance, key_code, timeout):
+        if self._serial is None:
+            self._serial = Serial(self.port, timeout=timeout)
+        self._serial.timeout = timeout
+        self._serial.reset_input_buffer()  # discard a late reply to an earlier command that timed out
+
+        with metrics.timed('TvCom', instance.long_name, 'serial'):
+            self._serial.write(f"{instance.name} 00 {instance.get_keycode(key_code)}\r".encode())
+            response = self._serial.read(10).decode()
+        # The reply echoes the second letter of the command, anything else belongs to some other command
+        if response[:1] != instance.name[1:2]:
+            metrics.error('TvCom', instance.long_name, 'serial', 'timeout' if not response else 'error')
+            return False, None
+        success = True if response[5:7] == "OK" else False
+        payload = instance.get_desc(response[7:9])
+        if success:
+            self.cache.set(instance.long_name, payload)
+        else:
+            metrics.error('TvCom', instance.long_name, 'serial')
+        return success, payload
+
+    def _adjust(self, instance, delta, timeout):
+        value = self.cache.get(instance.long_name)
+        if value is None:
+            success, value = self._comm(instance, 'status', timeout)
+            if not success:
+                return success, value
+        return self._comm(instance, max(0, min(value + delta, 100)), timeout)
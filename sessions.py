@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+import socket
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.connectionpool import HTTPConnectionPool
+
+pools = {}  # name -> HostPool, every pool created through host_pool() for reporting
+
+
+# A keep-alive requests session dedicated to a single device, so each call reuses an open TCP connection rather than
+# paying for a new handshake
+class HostPool:
+    def __init__(self, host, pool_size=1, connect_timeout=1.5, read_timeout=5, retries=1):
+        self.host = host  # host or host:port every request path is sent to
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.requests = 0
+        self.connections = 0
+        self.reconnects = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()  # whether the calling thread's current attempt opened a new connection
+
+        self.session = requests.Session()
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('http://', self.adapter)
+
+        # urllib3 quietly reopens connections it finds dropped, so count every TCP connect from the connection itself
+        host_pool = self
+
+        class Connection(HTTPConnection):
+            def connect(self):
+                host_pool._count('connections')
+                host_pool._local.connected = True
+                super().connect()
+
+        class ConnectionPool(HTTPConnectionPool):
+            ConnectionCls = Connection
+
+        self.adapter.poolmanager.pool_classes_by_scheme = {'http': ConnectionPool}
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def request(self, method, path, **kwargs):
+        url = f'http://{self.host}{path}'
+        kwargs.setdefault('timeout', self.timeout)
+        attempt = 0
+        while True:
+            self._count('requests')
+            self._local.connected = False
+            try:
+                return self.session.request(method, url, **kwargs)
+            except requests.exceptions.ConnectionError as e:
+                # Devices silently drop idle keep-alive connections, retry on a fresh one. Only a reused connection is
+                # retried, a failure on a new one means the device itself is refusing or dropping us. Timeouts are not
+                # retried as the device is just slow or gone. A device can still act on a request and then drop the
+                # connection, so pools for non idempotent commands should be built with retries=0
+                if isinstance(e, requests.exceptions.Timeout) or self._local.connected or attempt >= self.retries:
+                    raise
+                attempt += 1
+                self._count('reconnects')
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def put(self, path, **kwargs):
+        return self.request('PUT', path, **kwargs)
+
+    # Whether the host accepts a TCP connection within the connect timeout, a cheap health check for any HTTP device
+    def probe(self):
+        host, _, port = self.host.partition(':')
+        try:
+            socket.create_connection((host, int(port or 80)), self.timeout[0]).close()
+            return True
+        except OSError:
+            return False
+
+    def stats(self):
+        with self._lock:
+            return {'requests': self.requests, 'new_connections': self.connections,
+                    'reused_connections': max(0, self.requests - self.connections), 'reconnects': self.reconnects}
+
+
+def host_pool(name, host, **settings):
+    pools[name] = HostPool(host, **settings)
+    return pools[name]
+
+
+def stats():
+    return {name: pool.stats() for name, pool in pools.items()}
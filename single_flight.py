@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+
+import threading
+from concurrent.futures import Future
+import metrics
+
+saved = metrics.Counter('restate_coalesced_calls_total', 'Device calls saved by joining an identical call already in flight',
+                        ('resource', 'device'))
+
+
+# Collapses concurrent identical reads into one. The first caller for a key makes the call, anyone asking for the same
+# key before it returns waits for and shares its result (or exception) instead of making their own
+class SingleFlight:
+    def __init__(self, resource):
+        self.resource = resource  # metrics label
+        self._lock = threading.Lock()
+        self._calls = {}  # key -> Future of the call in flight
+
+    def do(self, key, func, *args):
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+        if not leader:
+            saved.inc(self.resource, key)
+            return future.result()
+
+        try:
+            result = func(*args)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+import threading
+from time import monotonic
+
+
+def _copy(state):
+    return dict(state) if isinstance(state, dict) else state
+
+
+class StateCache:
+    def __init__(self, max_age, on_change=None):
+        self.max_age = max_age
+        self.on_change = on_change  # called with (key, state) whenever a set or update changes what is stored
+        self._lock = threading.Lock()
+        self._entries = {}  # key -> [timestamp, state]
+
+    # Return the cached state for key, or None if there is no entry or it is older than max_age seconds
+    def get(self, key, max_age=None):
+        max_age = self.max_age if max_age is None else max_age
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or monotonic() - entry[0] > max_age:
+                return None
+            return _copy(entry[1])
+
+    # Every entry younger than max_age seconds, as a list of (key, state)
+    def items(self, max_age=None):
+        max_age = self.max_age if max_age is None else max_age
+        now = monotonic()
+        with self._lock:
+            return [(key, _copy(state)) for key, (stamp, state) in self._entries.items() if now - stamp <= max_age]
+
+    # Store a full read of a device's state, resetting its age
+    def set(self, key, state):
+        with self._lock:
+            entry = self._entries.get(key)
+            changed = entry is None or entry[1] != state
+            self._entries[key] = [monotonic(), state]
+        if changed and self.on_change is not None:
+            self.on_change(key, _copy(state))
+
+    # Merge a partial state (e.g the result of a SET) into an existing entry. The age is left alone so that
+    # fields we did not touch still expire on schedule
+    def update(self, key, fields):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            changed = any(entry[1].get(k) != v for k, v in fields.items())
+            entry[1].update(fields)
+            state = _copy(entry[1])
+        if changed and self.on_change is not None:
+            self.on_change(key, state)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class Refresher(threading.Thread):
+    def __init__(self, interval, refresh):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.refresh = refresh
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                self.refresh()
+            except Exception:
+                pass  # a failed sweep just leaves the previous entries to age out
+            self._stopped.wait(self.interval)
+
+    def stop(self):
+        self._stopped.set()